@@ -14,6 +14,7 @@ from .models import (
     Notification,
     UserNotificationSettings,
 )
+from .signals import vehicles_changed
 
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
@@ -50,5 +51,12 @@ class VehicleMasterAdmin(admin.ModelAdmin):
         "permit_registration_date",
         "permit_registration_expiry_date",
     ]
+    # Only writes bump it; a hand-edited version would break ETags and If-Match
+    readonly_fields = ["version"]
+
+    def save_related(self, request, form, formsets, change):
+        # Runs after the M2M permits are saved, so derived data sees the final state
+        super().save_related(request, form, formsets, change)
+        vehicles_changed.send(sender=VehicleMaster, chassis_numbers=[form.instance.pk])
 
 admin.site.register(VehicleMaster, VehicleMasterAdmin)
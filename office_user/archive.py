@@ -0,0 +1,195 @@
+"""
+Cold archive of old change-log rows.
+
+archive_change_log moves ChangeSets older than the retention age out of
+the database into one gzip-compressed NDJSON file per calendar month
+(UTC) under settings.CHANGE_LOG_ARCHIVE_ROOT. Rows are stored newest
+first, matching the order the change log is read in. Next to every file
+sits a small JSON manifest: row count, first/last timestamp and the
+chassis numbers and usernames it contains. Readers use it to skip files
+that cannot match.
+
+Archived rows keep their ids and timestamps and are read back as unsaved
+ChangeSet instances, so the change-log API, as-of reconstruction and
+change-log exports can continue past the live table transparently.
+Everything archived is older than every live row.
+"""
+import gzip
+import json
+import os
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ChangeSet
+
+ARCHIVE_DELETE_CHUNK_SIZE = 500
+
+def archive_root():
+    return Path(getattr(settings, "CHANGE_LOG_ARCHIVE_ROOT", Path(settings.BASE_DIR) / "archive" / "change_log"))
+
+def retention_days():
+    return getattr(settings, "CHANGE_LOG_RETENTION_DAYS", 365)
+
+def _paths(month):
+    root = archive_root()
+    return root / f"change_set-{month}.ndjson.gz", root / f"change_set-{month}.json"
+
+def _to_record(changeset):
+    return {
+        "id": changeset.id,
+        "timestamp": changeset.timestamp.isoformat(),
+        "chassis_number": changeset.chassis_number,
+        "plate_number": changeset.plate_number,
+        "username": changeset.username,
+        "changes": changeset.changes,
+    }
+
+def _from_record(record):
+    return ChangeSet(
+        id=record["id"],
+        timestamp=datetime.fromisoformat(record["timestamp"]),
+        chassis_number=record["chassis_number"],
+        plate_number=record["plate_number"],
+        username=record["username"],
+        changes=record["changes"],
+    )
+
+def manifests():
+    """Manifests of every archive file, newest month first."""
+    root = archive_root()
+    if not root.is_dir():
+        return []
+    found = []
+    for path in root.glob("change_set-*.json"):
+        with open(path) as f:
+            found.append(json.load(f))
+    return sorted(found, key=lambda m: m["month"], reverse=True)
+
+def horizon():
+    """Timestamp of the newest archived row, or None if nothing is archived."""
+    latest = [datetime.fromisoformat(m["last"]) for m in manifests() if m["rows"]]
+    return max(latest) if latest else None
+
+def _iter_month(month):
+    """Stream one month's records, newest first, without loading the file."""
+    data_path, _ = _paths(month)
+    if not data_path.exists():
+        return
+    with gzip.open(data_path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+def _read_month(month):
+    return list(_iter_month(month))
+
+def _write_month(month, records):
+    """Atomically replace one month's file and manifest with records (newest first)."""
+    data_path, manifest_path = _paths(month)
+    data_path.parent.mkdir(parents=True, exist_ok=True)
+    partial = data_path.with_name(data_path.name + ".part")
+    with gzip.open(partial, "wt", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+    manifest = {
+        "month": month,
+        "file": data_path.name,
+        "rows": len(records),
+        "first": records[-1]["timestamp"] if records else None,
+        "last": records[0]["timestamp"] if records else None,
+        "chassis_numbers": sorted({r["chassis_number"] for r in records}),
+        "usernames": sorted({r["username"] for r in records if r["username"]}),
+    }
+    manifest_partial = manifest_path.with_name(manifest_path.name + ".part")
+    with open(manifest_partial, "w") as f:
+        json.dump(manifest, f)
+    os.replace(partial, data_path)
+    os.replace(manifest_partial, manifest_path)
+
+def _month_bounds(moment):
+    start = moment.astimezone(dt_timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start.strftime("%Y-%m"), start, end
+
+def archive_change_log(older_than=None, progress=None):
+    """
+    Move ChangeSets with timestamp before older_than (default: the
+    retention age) into the monthly archive, one month at a time. A month
+    that was partly archived before is merged by id, so reruns after an
+    interruption never duplicate rows. Returns the number of rows moved.
+    """
+    if older_than is None:
+        older_than = timezone.now() - timedelta(days=retention_days())
+    moved = 0
+    while True:
+        oldest = ChangeSet.objects.filter(timestamp__lt=older_than).order_by("timestamp").values_list("timestamp", flat=True).first()
+        if oldest is None:
+            return moved
+        month, start, end = _month_bounds(oldest)
+        qs = ChangeSet.objects.filter(timestamp__gte=start, timestamp__lt=min(end, older_than))
+
+        records = {r["id"]: r for r in _read_month(month)}
+        ids = []
+        for changeset in qs.order_by("id").iterator(chunk_size=2000):
+            records[changeset.id] = _to_record(changeset)
+            ids.append(changeset.id)
+        ordered = sorted(records.values(), key=lambda r: (datetime.fromisoformat(r["timestamp"]), r["id"]), reverse=True)
+        _write_month(month, ordered)
+
+        # The file is in place before anything is deleted
+        with transaction.atomic():
+            for chunk_start in range(0, len(ids), ARCHIVE_DELETE_CHUNK_SIZE):
+                ChangeSet.objects.filter(id__in=ids[chunk_start:chunk_start + ARCHIVE_DELETE_CHUNK_SIZE]).delete()
+        moved += len(ids)
+        if progress:
+            progress(month, len(ids))
+
+def iter_archived(before=None, after=None, until=None, chassis_numbers=None, username_prefix=None, ascending=False):
+    """
+    Yield archived ChangeSets newest first (oldest first with ascending).
+
+    before is an exclusive (timestamp, id) keyset position, after an
+    exclusive and until an inclusive timestamp bound; only the months
+    overlapping them are opened. chassis_numbers and username_prefix only
+    skip archive files whose manifest rules them out; callers still filter
+    the rows themselves. Newest first streams each file; ascending holds
+    one month at a time, as the files are stored newest first.
+    """
+    selected = []
+    for manifest in manifests():
+        if not manifest["rows"]:
+            continue
+        if before is not None and datetime.fromisoformat(manifest["first"]) > before[0]:
+            continue
+        if after is not None and datetime.fromisoformat(manifest["last"]) <= after:
+            continue
+        if until is not None and datetime.fromisoformat(manifest["first"]) > until:
+            continue
+        if chassis_numbers is not None and not set(chassis_numbers) & set(manifest["chassis_numbers"]):
+            continue
+        if username_prefix and not any(u.startswith(username_prefix) for u in manifest["usernames"]):
+            continue
+        selected.append(manifest["month"])
+    if ascending:
+        selected.reverse()
+
+    for month in selected:
+        records = _iter_month(month)
+        if ascending:
+            records = reversed(list(records))
+        for record in records:
+            changeset = _from_record(record)
+            if before is not None and (changeset.timestamp, changeset.id) >= before:
+                continue
+            if until is not None and changeset.timestamp > until:
+                if ascending:
+                    break
+                continue
+            if after is not None and changeset.timestamp <= after:
+                if ascending:
+                    continue
+                break
+            yield changeset
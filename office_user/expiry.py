@@ -0,0 +1,170 @@
+"""
+Document expiry notifications.
+
+Each rule names a vehicle document expiry date, the notification type it
+raises and how many days ahead it warns. The dates are mirrored into
+ExpiryEvent rows (one per vehicle and document) by sync_expiry_events,
+which runs after commit on every vehicles_changed signal, so the engine
+and the list API's expiry filters read date ranges off an index instead
+of scanning four columns of the fleet.
+
+A run reads the office users and their settings once, then per rule the
+events inside the warning window and the notifications already raised
+for them, and inserts the missing (user, vehicle, type) notifications in
+fixed-size batches. The unique constraint on those three columns makes concurrent or
+repeated runs harmless. An incremental run only looks at events whose
+window opened since the last run, or whose date was edited since it;
+a full run rechecks every open window, which also covers users that
+joined or changed their settings in between.
+"""
+import itertools
+from collections import namedtuple
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ExpiryEvent, ExpiryRun, Notification, UserNotificationSettings, VehicleMaster
+
+NOTIFY_GROUP = "office_user"
+NOTIFICATION_BATCH_SIZE = 1000
+SYNC_CHUNK_SIZE = 500
+
+ExpiryRule = namedtuple("ExpiryRule", "notification_type field days setting")
+
+EXPIRY_RULES = [
+    ExpiryRule("truck", "truck_registration_expiry_date", 90, "truck_registration_expiry_notifications"),
+    ExpiryRule("insurance", "insurance_registration_expiry_date", 30, "insurance_expiry_notifications"),
+    ExpiryRule("mulkia", "mulkia_registration_expiry_date", 45, "mulkia_expiry_notifications"),
+    ExpiryRule("permit", "permit_registration_expiry_date", 60, "permit_expiry_notifications"),
+]
+
+def notification_message(rule, plate_number, expires):
+    return f"The {rule.notification_type.replace('_', ' ')} for vehicle {plate_number} is expiring on {expires}."
+
+# -------------------------------
+# Expiry events
+# -------------------------------
+
+def sync_expiry_events(chassis_numbers, chunk_size=SYNC_CHUNK_SIZE):
+    """
+    Bring the ExpiryEvent rows of the given vehicles in line with their
+    expiry columns: create, re-date (stamping changed_at) or delete.
+    Deleted vehicles lose their events through the foreign key.
+    """
+    chassis_numbers = list(chassis_numbers)
+    now = timezone.now()
+    fields = [rule.field for rule in EXPIRY_RULES]
+    for start in range(0, len(chassis_numbers), chunk_size):
+        chunk = chassis_numbers[start:start + chunk_size]
+        wanted = {}
+        for chassis_number, *dates in VehicleMaster.objects.filter(pk__in=chunk).values_list("pk", *fields):
+            for rule, expires_on in zip(EXPIRY_RULES, dates):
+                if expires_on is not None:
+                    wanted[(chassis_number, rule.notification_type)] = expires_on
+
+        stale, changed = [], []
+        for event in ExpiryEvent.objects.filter(vehicle_id__in=chunk):
+            expires_on = wanted.pop((event.vehicle_id, event.notification_type), None)
+            if expires_on is None:
+                stale.append(event.pk)
+            elif expires_on != event.expires_on:
+                event.expires_on = expires_on
+                event.changed_at = now
+                changed.append(event)
+        if stale:
+            ExpiryEvent.objects.filter(pk__in=stale).delete()
+        ExpiryEvent.objects.bulk_update(changed, ["expires_on", "changed_at"])
+        ExpiryEvent.objects.bulk_create(
+            [
+                ExpiryEvent(vehicle_id=chassis_number, notification_type=notification_type, expires_on=expires_on, changed_at=now)
+                for (chassis_number, notification_type), expires_on in wanted.items()
+            ],
+            ignore_conflicts=True,
+        )
+
+def rebuild_expiry_events():
+    """Resync the events of every vehicle, e.g. after writes that bypassed vehicles_changed."""
+    sync_expiry_events(VehicleMaster.objects.order_by("pk").values_list("pk", flat=True).iterator())
+
+# -------------------------------
+# Notifications
+# -------------------------------
+
+def _office_users():
+    """Office users with their notification settings, creating missing settings rows."""
+    users = list(
+        User.objects.filter(groups__name=NOTIFY_GROUP).distinct().select_related("notification_settings").order_by("pk")
+    )
+    missing = [user for user in users if not hasattr(user, "notification_settings")]
+    if missing:
+        UserNotificationSettings.objects.bulk_create(
+            [UserNotificationSettings(user=user) for user in missing], ignore_conflicts=True
+        )
+        settings = {s.user_id: s for s in UserNotificationSettings.objects.filter(user__in=missing)}
+        for user in missing:
+            user.notification_settings = settings[user.pk]
+    return users
+
+def _due_events(rule, today, since=None):
+    """Events of one rule inside their warning window; with since, only newly opened or edited ones."""
+    events = ExpiryEvent.objects.filter(
+        notification_type=rule.notification_type,
+        expires_on__range=(today, today + timedelta(days=rule.days)),
+    )
+    if since is not None:
+        # The window of an event opens `days` before it expires
+        events = events.filter(Q(expires_on__gt=since.checked_on + timedelta(days=rule.days)) | Q(changed_at__gte=since.started_at))
+    return events
+
+def check_expirations(today=None, incremental=False):
+    """
+    Raise every missing expiry notification and record the run. An
+    incremental run with no earlier run to start from is a full run.
+    Returns {notification type: created}.
+    """
+    started_at = timezone.now()
+    today = today or timezone.localdate()
+    since = ExpiryRun.objects.order_by("-started_at").first() if incremental else None
+    users = _office_users()
+    created = {}
+    for rule in EXPIRY_RULES:
+        recipients = [user.pk for user in users if getattr(user.notification_settings, rule.setting)]
+        if not recipients:
+            created[rule.notification_type] = 0
+            continue
+        events = _due_events(rule, today, since)
+        existing = set(
+            Notification.objects.filter(notification_type=rule.notification_type, vehicle_id__in=events.values("vehicle_id"))
+            .values_list("user_id", "vehicle_id")
+        )
+        notifications = (
+            Notification(
+                user_id=user_id,
+                vehicle_id=chassis_number,
+                notification_type=rule.notification_type,
+                message=notification_message(rule, plate_number, expires),
+            )
+            for chassis_number, plate_number, expires in events.values_list(
+                "vehicle_id", "vehicle__plate_number", "expires_on"
+            ).iterator(chunk_size=NOTIFICATION_BATCH_SIZE)
+            for user_id in recipients
+            if (user_id, chassis_number) not in existing
+        )
+        # Insert batch by batch so memory stays flat however many are due
+        created[rule.notification_type] = 0
+        while True:
+            batch = list(itertools.islice(notifications, NOTIFICATION_BATCH_SIZE))
+            if not batch:
+                break
+            Notification.objects.bulk_create(batch, batch_size=NOTIFICATION_BATCH_SIZE, ignore_conflicts=True)
+            created[rule.notification_type] += len(batch)
+
+    ExpiryRun.objects.create(
+        started_at=started_at,
+        checked_on=today,
+        incremental=since is not None,
+        created=sum(created.values()),
+    )
+    return created
@@ -0,0 +1,221 @@
+"""
+Background export jobs.
+
+A request for an export creates an ExportJob; the job is run off the
+request path (on a thread of the web process, or by the run_export_jobs
+worker when settings.EXPORT_JOBS_IN_PROCESS is False) and writes a
+gzip-compressed CSV or NDJSON artifact under settings.EXPORT_ROOT,
+updating rows_done after every chunk so clients can poll for progress.
+
+Artifacts are keyed by the data they cover: the fleet DataVersion for the
+vehicle export, the last ChangeSet id for the change log. While that has
+not moved, every request for the same export gets the finished job back
+and costs no export work. Change-log artifacts are refreshed
+incrementally: ChangeSets are append-only, so a newer export copies the
+previous artifact and appends only the new rows as one more gzip member
+(concatenated gzip members decompress as a single stream). A change-log
+export built from scratch starts with the archived rows (archive.py).
+"""
+import gzip
+import itertools
+import logging
+import os
+import shutil
+import threading
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from . import archive, exports
+from .models import ChangeSet, DataVersion, ExportJob, VehicleMaster
+
+logger = logging.getLogger(__name__)
+
+# A job that has not finished this long after it was created is presumed
+# lost with its process; it is no longer handed out and gets marked failed
+EXPORT_JOB_TIMEOUT = timedelta(hours=1)
+
+# A superseded artifact stays downloadable this long after the job that
+# replaced it finished, so interrupted downloads can still resume
+EXPORT_ARTIFACT_GRACE = timedelta(hours=1)
+
+def export_root():
+    return Path(getattr(settings, "EXPORT_ROOT", Path(settings.BASE_DIR) / "exports"))
+
+def artifact_path(job):
+    return export_root() / job.file_name
+
+def current_data_version(kind):
+    if kind == ExportJob.VEHICLES:
+        return DataVersion.current(DataVersion.FLEET).version
+    return ChangeSet.objects.aggregate(last=Max("id"))["last"] or 0
+
+def request_export(kind, fmt, user=None):
+    """
+    Return (job, created) for an export of the current data: the existing
+    job for this data version if one is queued, running or finished, else
+    a newly queued one.
+    """
+    version = current_data_version(kind)
+    live = ExportJob.objects.filter(
+        kind=kind,
+        format=fmt,
+        data_version=version,
+        created_at__gte=timezone.now() - EXPORT_JOB_TIMEOUT,
+        status__in=[ExportJob.PENDING, ExportJob.RUNNING],
+    )
+    done = ExportJob.objects.filter(kind=kind, format=fmt, data_version=version, status=ExportJob.DONE)
+    for job in [*done.order_by("-finished_at")[:1], *live.order_by("-created_at")[:1]]:
+        if job.status != ExportJob.DONE or artifact_path(job).exists():
+            return job, False
+
+    job = ExportJob.objects.create(
+        kind=kind,
+        format=fmt,
+        data_version=version,
+        created_by=user if user is not None and user.is_authenticated else None,
+    )
+    if getattr(settings, "EXPORT_JOBS_IN_PROCESS", True):
+        transaction.on_commit(lambda: threading.Thread(target=_run_in_thread, args=(job.pk,), daemon=True).start())
+    return job, True
+
+def _run_in_thread(job_id):
+    try:
+        run_job(job_id)
+    finally:
+        connection.close()
+
+def fail_stale_jobs():
+    """Mark jobs that outlived EXPORT_JOB_TIMEOUT as failed. Returns how many."""
+    return ExportJob.objects.filter(
+        status__in=[ExportJob.PENDING, ExportJob.RUNNING],
+        created_at__lt=timezone.now() - EXPORT_JOB_TIMEOUT,
+    ).update(status=ExportJob.FAILED, error="Timed out", finished_at=timezone.now())
+
+def run_next_job():
+    """Run the oldest pending job, if any. Returns True if one was run."""
+    for job_id in ExportJob.objects.filter(status=ExportJob.PENDING).order_by("created_at").values_list("id", flat=True)[:5]:
+        if run_job(job_id):
+            return True
+    return False
+
+def run_job(job_id):
+    """
+    Claim and run one pending job. Returns False if another runner claimed
+    it first. Failures are recorded on the job, not raised.
+    """
+    claimed = ExportJob.objects.filter(pk=job_id, status=ExportJob.PENDING).update(
+        status=ExportJob.RUNNING, started_at=timezone.now()
+    )
+    if not claimed:
+        return False
+    job = ExportJob.objects.get(pk=job_id)
+    job.file_name = f"{job.kind}-{job.data_version}-{job.pk}.{job.format}.gz"
+    root = export_root()
+    root.mkdir(parents=True, exist_ok=True)
+    partial = root / f"{job.file_name}.part"
+    try:
+        with open(partial, "wb") as out:
+            if job.kind == ExportJob.VEHICLES:
+                rows = _write_vehicles(job, out)
+            else:
+                rows = _write_change_log(job, out)
+        os.replace(partial, artifact_path(job))
+    except Exception as e:
+        logger.exception("Export job %s failed", job.pk)
+        partial.unlink(missing_ok=True)
+        ExportJob.objects.filter(pk=job.pk).update(status=ExportJob.FAILED, error=str(e), finished_at=timezone.now())
+        return True
+
+    ExportJob.objects.filter(pk=job.pk).update(
+        status=ExportJob.DONE,
+        file_name=job.file_name,
+        size=artifact_path(job).stat().st_size,
+        rows_done=rows,
+        finished_at=timezone.now(),
+    )
+    _prune_superseded(job)
+    return True
+
+def _tracked(job, chunks, done=0):
+    """Pass chunks through, recording progress on the job after each one."""
+    for chunk in chunks:
+        yield chunk
+        done += len(chunk)
+        ExportJob.objects.filter(pk=job.pk).update(rows_done=done)
+
+def _write_text(out, texts):
+    with gzip.GzipFile(fileobj=out, mode="wb", mtime=0) as gz:
+        for text in texts:
+            gz.write(text.encode("utf-8"))
+
+def _encode(fmt, chunks, columns, header=True):
+    if fmt == ExportJob.NDJSON:
+        return exports.iter_ndjson(chunks, columns)
+    return exports.iter_csv(chunks, columns, header=header)
+
+def _write_vehicles(job, out):
+    total = VehicleMaster.objects.count()
+    ExportJob.objects.filter(pk=job.pk).update(rows_total=total)
+    _write_text(out, _encode(job.format, _tracked(job, exports.iter_export_rows()), exports.EXPORT_COLUMNS))
+    return total
+
+def _write_change_log(job, out):
+    base = _change_log_base(job)
+    after = base.data_version if base else 0
+    if base:
+        with open(artifact_path(base), "rb") as previous:
+            shutil.copyfileobj(previous, out)
+    done = base.rows_done if base else 0
+    total = done + ChangeSet.objects.filter(id__gt=after, id__lte=job.data_version).count()
+    if base is None:
+        total += sum(m["rows"] for m in archive.manifests())
+    ExportJob.objects.filter(pk=job.pk).update(rows_total=total, rows_done=done)
+
+    live = exports.iter_changesets(after_id=after, up_to_id=job.data_version)
+    if base is None:
+        live = itertools.chain(exports.iter_archived_changesets(), live)
+    changesets = _tracked(job, live, done=done)
+    rows = (exports.change_log_rows(chunk) for chunk in changesets)
+    _write_text(out, _encode(job.format, rows, exports.CHANGE_LOG_COLUMNS, header=base is None))
+    return total
+
+def _change_log_base(job):
+    """The newest finished change-log artifact this job can extend, if any."""
+    base = ExportJob.objects.filter(
+        kind=ExportJob.CHANGE_LOG,
+        format=job.format,
+        status=ExportJob.DONE,
+        data_version__lte=job.data_version,
+    ).order_by("-data_version", "-finished_at").first()
+    if base and artifact_path(base).exists():
+        return base
+    return None
+
+def _prune_superseded(job):
+    """
+    Delete artifacts of the same export that a job finished more than
+    EXPORT_ARTIFACT_GRACE ago has replaced.
+    """
+    replacement = ExportJob.objects.filter(
+        kind=job.kind,
+        format=job.format,
+        status=ExportJob.DONE,
+        finished_at__lt=timezone.now() - EXPORT_ARTIFACT_GRACE,
+    ).order_by("-created_at").first()
+    if replacement is None:
+        return
+    superseded = ExportJob.objects.filter(
+        kind=job.kind,
+        format=job.format,
+        status__in=[ExportJob.DONE, ExportJob.FAILED],
+        created_at__lt=replacement.created_at,
+    )
+    for old in superseded:
+        if old.file_name:
+            artifact_path(old).unlink(missing_ok=True)
+    superseded.delete()
@@ -0,0 +1,156 @@
+"""
+Chunked vehicle export.
+
+Rows are read as plain tuples in keyset-ordered chunks of EXPORT_CHUNK_SIZE,
+with lookup names joined in and each vehicle's emirates permits folded
+into one column by a correlated group_concat subquery, so the whole export
+costs one query per chunk and memory stays bounded by the chunk size.
+Column names match what the CSV import accepts, so an export can be edited
+and imported back. The change log is exported the same way, one row per
+changed field, walking ChangeSets in id order; a full change-log export
+starts with the rows moved to the cold archive.
+
+The same chunks feed every output format: CSV, gzip-compressed NDJSON
+(compressed incrementally, chunk by chunk) and XLSX through openpyxl's
+write-only mode, which spools rows to a temporary file rather than
+building the worksheet in memory.
+"""
+import csv
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Aggregate, CharField, OuterRef, Subquery, Value
+
+from . import archive
+from .models import ChangeEntry, ChangeSet, VehicleMaster
+
+try:
+    import openpyxl
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+except ImportError:  # optional; only needed for XLSX exports
+    openpyxl = None
+
+EXPORT_CHUNK_SIZE = 2000
+
+PERMIT_SEPARATOR = "; "
+
+EXPORT_COLUMNS = [
+    f.name for f in VehicleMaster._meta.concrete_fields if f.name != "version"
+] + ["emirates_permit"]
+
+CHANGE_LOG_COLUMNS = list(ChangeEntry._fields)
+
+class GroupConcat(Aggregate):
+    """group_concat(expression, separator); STRING_AGG on PostgreSQL."""
+    function = "GROUP_CONCAT"
+    output_field = CharField()
+
+    def __init__(self, expression, separator, **extra):
+        super().__init__(expression, Value(separator), **extra)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, function="STRING_AGG", **extra_context)
+
+def _permit_names():
+    through = VehicleMaster.emirates_permit.through
+    return Subquery(
+        through.objects.filter(vehiclemaster_id=OuterRef("pk"))
+        .values("vehiclemaster_id")
+        .annotate(names=GroupConcat("emirate__name", PERMIT_SEPARATOR))
+        .values("names")
+    )
+
+def _export_values():
+    """values_list() arguments for EXPORT_COLUMNS: lookups by name, permits folded."""
+    values = []
+    for name in EXPORT_COLUMNS[:-1]:
+        field = VehicleMaster._meta.get_field(name)
+        values.append(f"{name}__name" if field.is_relation else name)
+    return values + ["permit_names"]
+
+def iter_export_rows(chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield lists of export row tuples (in EXPORT_COLUMNS order), chassis number order."""
+    qs = VehicleMaster.objects.annotate(permit_names=_permit_names()).order_by("pk").values_list(*_export_values())
+    page = qs
+    while True:
+        chunk = list(page[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        page = qs.filter(pk__gt=chunk[-1][0])
+
+def iter_archived_changesets(chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield lists of archived ChangeSets, oldest first."""
+    chunk = []
+    for changeset in archive.iter_archived(ascending=True):
+        chunk.append(changeset)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_changesets(after_id=0, up_to_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield lists of live ChangeSets with after_id < id <= up_to_id, oldest first."""
+    qs = ChangeSet.objects.filter(id__gt=after_id).order_by("id")
+    if up_to_id is not None:
+        qs = qs.filter(id__lte=up_to_id)
+    page = qs
+    while True:
+        chunk = list(page[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        page = qs.filter(id__gt=chunk[-1].id)
+
+def change_log_rows(changesets):
+    """Flatten ChangeSets into CHANGE_LOG_COLUMNS rows, one per changed field."""
+    return [entry for changeset in changesets for entry in changeset.entries()]
+
+class _Echo:
+    """File-like object whose write() returns the line, for csv.writer streaming."""
+    def write(self, value):
+        return value
+
+def iter_csv(chunks, columns=EXPORT_COLUMNS, header=True):
+    """CSV text for the header, then one string per chunk of rows."""
+    writer = csv.writer(_Echo())
+    if header:
+        yield writer.writerow(columns)
+    for chunk in chunks:
+        yield "".join(writer.writerow(["" if value is None else value for value in row]) for row in chunk)
+
+def iter_ndjson(chunks, columns=EXPORT_COLUMNS):
+    """One JSON object per row, one string per chunk of rows."""
+    for chunk in chunks:
+        yield "".join(json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + "\n" for row in chunk)
+
+def iter_gzip(texts):
+    """gzip-compress a stream of text incrementally, yielding bytes."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for text in texts:
+        data = compressor.compress(text.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def xlsx_supported():
+    return openpyxl is not None
+
+def _xlsx_value(value):
+    if isinstance(value, str):
+        return ILLEGAL_CHARACTERS_RE.sub("", value)
+    return value
+
+def write_xlsx(chunks, out, columns=EXPORT_COLUMNS, title="Vehicles"):
+    """Write chunks of rows to out (a path or binary file) as a one-sheet workbook."""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    sheet.append(columns)
+    for chunk in chunks:
+        for row in chunk:
+            sheet.append([_xlsx_value(value) for value in row])
+    workbook.save(out)
@@ -0,0 +1,245 @@
+"""
+Point-in-time ("as of") reconstruction of vehicles from the change log.
+
+A vehicle's state at time T is rebuilt backwards. Start from the first
+VehicleSnapshot taken after T, or from the current row if there is none.
+Then undo, newest first, every ChangeSet between T and that starting
+point by restoring each field's old value. snapshot_vehicles checkpoints
+every vehicle that has gathered SNAPSHOT_INTERVAL changes since its last
+checkpoint, so a reconstruction reads one snapshot and at most about that
+many ChangeSets, through the (chassis_number, timestamp) indexes.
+
+States are {field: value} in change-log display form: lookup names, ISO
+dates, file URLs. Emirates permits are not part of the change log and so
+are not reconstructed.
+
+ChangeSets moved to the cold archive (see archive.py) are undone as well:
+when `at` is older than the archive horizon, the archived ChangeSets
+after `at` are streamed from the monthly files, no further than the
+snapshot the replay starts from.
+"""
+from django.db import transaction
+from django.db.models import Count, Exists, F, Max, Min, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from . import archive, lookups
+from .models import ChangeSet, VehicleMaster, VehicleSnapshot
+from .writes import LOGGED_FIELDS, display_state
+
+SNAPSHOT_INTERVAL = 50
+SNAPSHOT_CHUNK_SIZE = 500
+
+AS_OF_COLUMNS = ["chassis_number"] + LOGGED_FIELDS
+
+def _undo(state, changesets):
+    """Roll state back through changesets given newest first."""
+    for changes in changesets:
+        for field, (old, new) in changes.items():
+            state[field] = old
+    return state
+
+def _up_to(snapshot):
+    """ChangeSets at or before a snapshot's position."""
+    return Q(timestamp__lt=snapshot.timestamp) | Q(timestamp=snapshot.timestamp, id__lte=snapshot.changeset_id)
+
+def _load_archived(at, chassis_numbers, until=None):
+    """
+    {chassis_number: [ChangeSet, ...]} for archived ChangeSets after `at`
+    and up to the `until` timestamp, newest first.
+    """
+    found = {}
+    newest = archive.horizon()
+    if newest is None or at >= newest:
+        return found
+    wanted = set(chassis_numbers)
+    for changeset in archive.iter_archived(after=at, until=until, chassis_numbers=wanted):
+        if changeset.chassis_number in wanted:
+            found.setdefault(changeset.chassis_number, []).append(changeset)
+    return found
+
+def _archived_changes(archived, chassis_number, snapshot):
+    """Archived changes of one vehicle, newest first, up to its snapshot if any."""
+    return [
+        changeset.changes
+        for changeset in archived.get(chassis_number, [])
+        if snapshot is None or (changeset.timestamp, changeset.id) <= (snapshot.timestamp, snapshot.changeset_id)
+    ]
+
+def _archived_oldest_changes(at, until=None):
+    """
+    {chassis_number: {field: ((timestamp, id), old value)}} holding, per
+    field, the oldest archived change after `at` (and up to `until`).
+    Undoing a run of changes leaves each field at the old value of the
+    oldest one, so this is all a replay needs from the archive; it grows
+    with the fleet, not with the archive.
+    """
+    oldest = {}
+    newest = archive.horizon()
+    if newest is None or at >= newest:
+        return oldest
+    # Newest first, so the oldest change of every field is written last
+    for changeset in archive.iter_archived(after=at, until=until):
+        fields = oldest.setdefault(changeset.chassis_number, {})
+        for field, (old, new) in changeset.changes.items():
+            fields[field] = ((changeset.timestamp, changeset.id), old)
+    return oldest
+
+def _fleet_archive_bound(at):
+    """
+    Newest timestamp any current vehicle replays archived rows up to: the
+    latest of their first snapshots after `at`, or None (no bound) while
+    some vehicle has no such snapshot and replays from its current row.
+    """
+    snapshot_after = VehicleSnapshot.objects.filter(chassis_number=OuterRef("pk"), timestamp__gt=at)
+    if VehicleMaster.objects.filter(~Exists(snapshot_after)).exists():
+        return None
+    firsts = (
+        VehicleSnapshot.objects.filter(chassis_number__in=VehicleMaster.objects.values("pk"), timestamp__gt=at)
+        .values("chassis_number")
+        .annotate(first=Min("timestamp"))
+    )
+    return firsts.aggregate(bound=Max("first"))["bound"]
+
+def vehicle_as_of(chassis_number, at):
+    """
+    Return (state, info) for one vehicle as it was at `at`, or None if it
+    neither exists now nor has a snapshot to start from. info says where
+    the replay started and how many ChangeSets it undid.
+    """
+    snapshot = (
+        VehicleSnapshot.objects.filter(chassis_number=chassis_number, timestamp__gt=at)
+        .order_by("timestamp", "changeset_id")
+        .first()
+    )
+    changesets = ChangeSet.objects.filter(chassis_number=chassis_number, timestamp__gt=at)
+    if snapshot:
+        state = dict(snapshot.data)
+        changesets = changesets.filter(_up_to(snapshot))
+    else:
+        vehicle = VehicleMaster.objects.filter(pk=chassis_number).first()
+        if vehicle is None:
+            return None
+        state = display_state(vehicle)
+    changes = list(changesets.order_by("-timestamp", "-id").values_list("changes", flat=True))
+    # Archived ChangeSets are older than every live one; none past the
+    # snapshot is needed, so later archive months are not even opened
+    archived = _load_archived(at, [chassis_number], until=snapshot.timestamp if snapshot else None)
+    changes += _archived_changes(archived, chassis_number, snapshot)
+    info = {
+        "replayed_from": snapshot.timestamp.isoformat() if snapshot else "current",
+        "changes_undone": len(changes),
+    }
+    return _undo(state, changes), info
+
+def _fleet_chunk_as_of(vehicles, at, archived=None):
+    """
+    States at `at` for a list of current vehicles, with three queries.
+    archived is the result of _archived_oldest_changes(at) for the fleet.
+    """
+    chassis_numbers = [v.pk for v in vehicles]
+    firsts = (
+        VehicleSnapshot.objects.filter(chassis_number__in=chassis_numbers, timestamp__gt=at)
+        .values("chassis_number")
+        .annotate(first=Min("timestamp"))
+    )
+    snapshots = {}
+    if firsts:
+        matching = Q()
+        for row in firsts:
+            matching |= Q(chassis_number=row["chassis_number"], timestamp=row["first"])
+        for snapshot in VehicleSnapshot.objects.filter(matching).order_by("-changeset_id"):
+            snapshots[snapshot.chassis_number] = snapshot
+
+    window = Q(chassis_number__in=[c for c in chassis_numbers if c not in snapshots])
+    for chassis_number, snapshot in snapshots.items():
+        window |= Q(chassis_number=chassis_number) & _up_to(snapshot)
+    changes = {}
+    for chassis_number, changeset in (
+        ChangeSet.objects.filter(window, timestamp__gt=at)
+        .order_by("-timestamp", "-id")
+        .values_list("chassis_number", "changes")
+    ):
+        changes.setdefault(chassis_number, []).append(changeset)
+
+    rows = []
+    for vehicle in vehicles:
+        snapshot = snapshots.get(vehicle.pk)
+        state = dict(snapshot.data) if snapshot else display_state(vehicle)
+        state = _undo(state, changes.get(vehicle.pk, []))
+        for field, (position, old) in (archived or {}).get(vehicle.pk, {}).items():
+            # The oldest change past the snapshot means none before it counts
+            if snapshot is None or position <= (snapshot.timestamp, snapshot.changeset_id):
+                state[field] = old
+        rows.append([vehicle.pk] + [state.get(field, "") for field in LOGGED_FIELDS])
+    return rows
+
+def iter_fleet_as_of(at, chunk_size=SNAPSHOT_CHUNK_SIZE):
+    """
+    Yield chunks of AS_OF_COLUMNS rows for every current vehicle as it was
+    at `at`, in chassis number order. The archive is streamed once up
+    front, only as far as the vehicles' snapshots reach, and reduced to
+    the oldest archived change per vehicle and field.
+    """
+    archived = _archived_oldest_changes(at, until=_fleet_archive_bound(at))
+    qs = VehicleMaster.objects.order_by("pk")
+    page = qs
+    while True:
+        vehicles = list(page[:chunk_size])
+        if vehicles:
+            yield _fleet_chunk_as_of(vehicles, at, archived)
+        if len(vehicles) < chunk_size:
+            return
+        page = qs.filter(pk__gt=vehicles[-1].pk)
+
+def vehicles_due_for_snapshot(interval=SNAPSHOT_INTERVAL):
+    """Chassis numbers with at least `interval` ChangeSets after their last snapshot."""
+    last_snapshot = (
+        VehicleSnapshot.objects.filter(chassis_number=OuterRef("chassis_number"))
+        .order_by("-changeset_id")
+        .values("changeset_id")[:1]
+    )
+    return list(
+        ChangeSet.objects.order_by()
+        .alias(last_snapshot=Coalesce(Subquery(last_snapshot), 0))
+        .filter(id__gt=F("last_snapshot"))
+        .values("chassis_number")
+        .annotate(pending=Count("id"))
+        .filter(pending__gte=interval)
+        .values_list("chassis_number", flat=True)
+    )
+
+def take_snapshots(chassis_numbers, chunk_size=SNAPSHOT_CHUNK_SIZE):
+    """
+    Checkpoint the current state of the given vehicles at their latest
+    ChangeSet. Vehicles without any ChangeSet are skipped: replaying from
+    their current row is already free. Returns the number of snapshots written.
+    """
+    written = 0
+    chassis_numbers = list(chassis_numbers)
+    for start in range(0, len(chassis_numbers), chunk_size):
+        chunk = chassis_numbers[start:start + chunk_size]
+        # Snapshots store lookup names; make sure they are the current ones
+        lookups.get_registry(max_age=0)
+        with transaction.atomic():
+            latest_ids = (
+                ChangeSet.objects.filter(chassis_number__in=chunk)
+                .values("chassis_number")
+                .annotate(last=Max("id"))
+                .values_list("last", flat=True)
+            )
+            latest = {
+                c.chassis_number: c
+                for c in ChangeSet.objects.filter(id__in=list(latest_ids)).only("id", "chassis_number", "timestamp")
+            }
+            snapshots = [
+                VehicleSnapshot(
+                    chassis_number=vehicle.pk,
+                    timestamp=latest[vehicle.pk].timestamp,
+                    changeset_id=latest[vehicle.pk].id,
+                    data=display_state(vehicle),
+                )
+                for vehicle in VehicleMaster.objects.filter(pk__in=list(latest))
+            ]
+            VehicleSnapshot.objects.bulk_create(snapshots)
+        written += len(snapshots)
+    return written
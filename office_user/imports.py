@@ -0,0 +1,170 @@
+"""
+Streaming CSV import of vehicles.
+
+The file is read row by row and handed to the bulk upsert engine in chunks
+of IMPORT_CHUNK_SIZE, so memory use does not grow with the file: only the
+current chunk and the lookup name map are held. Each chunk is validated
+and written in its own transaction; invalid rows are reported through a
+callback with their line number and skipped.
+
+Columns are the payload keys the JSON API accepts, matched
+case-insensitively ("Chassis Number" works too). Lookups may be given by
+name (make, status, ...) or id (make_id, status_id, ...); emirates_permit
+takes emirate names separated by ";". Document columns are ignored.
+"""
+import csv
+import re
+
+from .lookups import get_registry
+from .models import (
+    VehicleMaster,
+    VehicleCapacity,
+    VehicleType,
+    ToteCapacity,
+    Status,
+    VehicleConcept,
+    Make,
+    Emirate,
+    GPS,
+    BrandingStatus,
+    TailLiftBrand,
+)
+from .writes import BULK_FILE_FIELDS, bulk_upsert_vehicles
+
+IMPORT_CHUNK_SIZE = 500
+
+IMPORT_LOOKUP_COLUMNS = {
+    "vehicle_capacity": VehicleCapacity,
+    "vehicle_type": VehicleType,
+    "tote_capacity": ToteCapacity,
+    "status": Status,
+    "vehicle_concept": VehicleConcept,
+    "make": Make,
+    "gps": GPS,
+    "branding_status": BrandingStatus,
+    "tail_lift_brand": TailLiftBrand,
+}
+
+IMPORT_VALUE_COLUMNS = {
+    f.name for f in VehicleMaster._meta.concrete_fields
+    if not f.is_relation and f.name not in BULK_FILE_FIELDS
+} | {f"{name}_id" for name in IMPORT_LOOKUP_COLUMNS} | {"emirates_permit_ids"}
+
+PERMIT_SEPARATOR = re.compile(r"\s*[;|]\s*")
+
+class CSVFormatError(ValueError):
+    """The file as a whole cannot be imported (bad header or encoding)."""
+
+def _normalize_header(name):
+    return re.sub(r"[\s-]+", "_", (name or "").strip().lower())
+
+def _lookup_ids():
+    """{model: {casefolded name: id}} for every lookup table, built once per import."""
+    registry = get_registry()
+    return {
+        model: {name.casefold(): pk for pk, name in registry.names(model).items()}
+        for model in (*IMPORT_LOOKUP_COLUMNS.values(), Emirate)
+    }
+
+def _read_header(reader):
+    try:
+        header = next(reader)
+    except StopIteration:
+        raise CSVFormatError("The file is empty")
+    columns = [_normalize_header(name) for name in header]
+    if "chassis_number" not in columns:
+        raise CSVFormatError("The file has no chassis_number column")
+    duplicates = sorted({c for c in columns if c and columns.count(c) > 1})
+    if duplicates:
+        raise CSVFormatError(f"Duplicate columns: {', '.join(duplicates)}")
+    ignored = set(BULK_FILE_FIELDS) | {""}
+    unknown = [
+        c for c in columns
+        if c not in ignored and c not in IMPORT_VALUE_COLUMNS
+        and c not in IMPORT_LOOKUP_COLUMNS and c != "emirates_permit"
+    ]
+    if unknown:
+        raise CSVFormatError(f"Unknown columns: {', '.join(unknown)}")
+    return [None if c in ignored else c for c in columns]
+
+def _row_payload(columns, row, lookup_ids):
+    """Turn one CSV row into a bulk upsert payload; raises ValueError for bad lookup names."""
+    if len(row) > len(columns):
+        raise ValueError(f"Row has {len(row)} values but the header has {len(columns)} columns")
+    payload = {}
+    for column, value in zip(columns, row):
+        if column is None:
+            continue
+        value = value.strip()
+        if column in IMPORT_LOOKUP_COLUMNS:
+            if value:
+                model = IMPORT_LOOKUP_COLUMNS[column]
+                try:
+                    payload[f"{column}_id"] = lookup_ids[model][value.casefold()]
+                except KeyError:
+                    raise ValueError(f"Unknown {model._meta.verbose_name}: {value}")
+        elif column == "emirates_permit":
+            ids = []
+            for name in PERMIT_SEPARATOR.split(value) if value else []:
+                try:
+                    ids.append(lookup_ids[Emirate][name.casefold()])
+                except KeyError:
+                    raise ValueError(f"Unknown emirate: {name}")
+            payload["emirates_permit_ids"] = ids
+        elif column == "emirates_permit_ids":
+            payload[column] = [pk for pk in PERMIT_SEPARATOR.split(value) if pk] if value else []
+        else:
+            payload[column] = value
+    return payload
+
+def import_vehicles(lines, username=None, dry_run=False, chunk_size=IMPORT_CHUNK_SIZE,
+                    on_error=None, on_progress=None):
+    """
+    Import vehicles from an iterable of CSV text lines (an open file).
+
+    on_error(line, chassis_number, errors) is called for every rejected row
+    and on_progress(rows, counts) after every chunk. Returns the final
+    counts: rows / created / updated / unchanged / error. Raises
+    CSVFormatError if the file cannot be read at all; chunks written before
+    that point stay written.
+    """
+    reader = csv.reader(lines)
+    counts = {"rows": 0, "created": 0, "updated": 0, "unchanged": 0, "error": 0}
+    chunk = []
+
+    def report(line, chassis_number, errors):
+        counts["error"] += 1
+        if on_error:
+            on_error(line, chassis_number, errors)
+
+    def flush():
+        results = bulk_upsert_vehicles([payload for _, payload in chunk], username, dry_run=dry_run)
+        for (line, _), result in zip(chunk, results):
+            if result["status"] == "error":
+                report(line, result["chassis_number"], result["errors"])
+            else:
+                counts[result["status"]] += 1
+        chunk.clear()
+        if on_progress:
+            on_progress(counts["rows"], counts)
+
+    try:
+        columns = _read_header(reader)
+        lookup_ids = _lookup_ids()
+        for row in reader:
+            if not any(cell.strip() for cell in row):
+                continue
+            counts["rows"] += 1
+            try:
+                chunk.append((reader.line_num, _row_payload(columns, row, lookup_ids)))
+            except ValueError as e:
+                chassis_index = columns.index("chassis_number")
+                report(reader.line_num, row[chassis_index] if chassis_index < len(row) else None, {"__all__": [str(e)]})
+                continue
+            if len(chunk) >= chunk_size:
+                flush()
+    except (csv.Error, UnicodeDecodeError) as e:
+        raise CSVFormatError(f"Could not read line {reader.line_num + 1}: {e}")
+    if chunk:
+        flush()
+    return counts
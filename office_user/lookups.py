@@ -0,0 +1,106 @@
+"""
+Process-local registry of the dropdown lookup tables.
+
+The ten lookup tables are tiny and almost never change, so they are loaded
+once per process and served from memory to the dropdowns API, payload FK
+validation and serializer name resolution. Lookup writes invalidate the
+registry of the writing process directly (see signals.py) and bump the
+"lookups" DataVersion; other processes compare that version at most every
+REGISTRY_CHECK_INTERVAL seconds and reload when it moved. An id missing
+from the registry triggers a reload before it is rejected, so a lookup
+created by another process is accepted straight away; such reloads are
+also limited to one per REGISTRY_CHECK_INTERVAL, so a batch full of bad
+ids costs one reload rather than one per item. Writes of derived data
+(listings, change-log display values, snapshots) check the version first
+whatever the interval, at the cost of one primary-key read.
+"""
+import time
+
+from .models import (
+    VehicleCapacity,
+    VehicleType,
+    ToteCapacity,
+    Status,
+    VehicleConcept,
+    Make,
+    Emirate,
+    GPS,
+    BrandingStatus,
+    TailLiftBrand,
+    DataVersion,
+)
+
+LOOKUP_MODELS = (
+    VehicleCapacity,
+    VehicleType,
+    ToteCapacity,
+    Status,
+    VehicleConcept,
+    Make,
+    Emirate,
+    GPS,
+    BrandingStatus,
+    TailLiftBrand,
+)
+
+REGISTRY_CHECK_INTERVAL = 5.0
+
+class LookupRegistry:
+    def __init__(self, version):
+        self.version = version
+        self._names = {model: dict(model.objects.values_list("id", "name")) for model in LOOKUP_MODELS}
+
+    def names(self, model):
+        """{id: name} for one lookup table."""
+        return self._names[model]
+
+    def name(self, model, pk):
+        return self._names[model].get(pk)
+
+    def options(self, model):
+        """Dropdown options for one lookup table, ordered by name."""
+        return [{"id": pk, "name": name} for pk, name in sorted(self._names[model].items(), key=lambda item: item[1])]
+
+_registry = None
+_checked_at = 0.0
+_miss_reloaded_at = None
+
+def get_registry(max_age=REGISTRY_CHECK_INTERVAL):
+    """
+    The registry, re-checked against the "lookups" version once it is older
+    than max_age seconds. Paths that store names in derived data pass
+    max_age=0, so a rename in another process is never written back stale.
+    """
+    global _registry, _checked_at
+    now = time.monotonic()
+    if _registry is not None and now - _checked_at < max_age:
+        return _registry
+    version = DataVersion.current(DataVersion.LOOKUPS).version
+    if _registry is None or _registry.version != version:
+        _registry = LookupRegistry(version)
+    _checked_at = now
+    return _registry
+
+def invalidate():
+    global _registry
+    _registry = None
+
+def resolve(model, value):
+    """
+    Validate a lookup id taken from a request payload and return it as the
+    stored primary key. Raises model.DoesNotExist for unknown ids.
+    """
+    global _miss_reloaded_at
+    try:
+        pk = int(value)
+    except (ValueError, TypeError):
+        # Fall back if PK is non-integer type
+        pk = value
+    if pk not in get_registry().names(model):
+        now = time.monotonic()
+        if _miss_reloaded_at is None or now - _miss_reloaded_at >= REGISTRY_CHECK_INTERVAL:
+            _miss_reloaded_at = now
+            invalidate()
+        if pk not in get_registry().names(model):
+            raise model.DoesNotExist(f"{model._meta.verbose_name} matching id {value} does not exist.")
+    return pk
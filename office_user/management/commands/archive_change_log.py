@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from office_user import archive
+
+class Command(BaseCommand):
+    help = 'Moves old change log entries into compressed monthly archive files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Archive entries older than this many days (default: CHANGE_LOG_RETENTION_DAYS)')
+        parser.add_argument('--before', help='Archive entries before this date (YYYY-MM-DD) instead')
+
+    def handle(self, *args, **options):
+        if options['before']:
+            day = parse_date(options['before'])
+            if day is None:
+                raise CommandError('--before must be a date (YYYY-MM-DD)')
+            cutoff = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+        else:
+            days = archive.retention_days() if options['days'] is None else options['days']
+            if days < 0:
+                raise CommandError('--days must not be negative')
+            cutoff = timezone.now() - timedelta(days=days)
+
+        def progress(month, rows):
+            self.stdout.write(f"{month}: archived {rows} entries")
+
+        moved = archive.archive_change_log(cutoff, progress=progress)
+        self.stdout.write(self.style.SUCCESS(f"Archived {moved} change log entries older than {cutoff:%Y-%m-%d %H:%M}"))
@@ -0,0 +1,67 @@
+import csv
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from office_user.imports import IMPORT_CHUNK_SIZE, CSVFormatError, import_vehicles
+
+class Command(BaseCommand):
+    help = 'Creates or updates vehicles from a CSV file, in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file to import, or - for stdin')
+        parser.add_argument('--dry-run', action='store_true', help='Validate every row without saving anything')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+        parser.add_argument('--user', help='Username recorded in the change log')
+        parser.add_argument('--errors', help='Write rejected rows to this CSV file instead of stderr')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        errors_file = open(options['errors'], 'w', newline='', encoding='utf-8') if options['errors'] else None
+        error_writer = csv.writer(errors_file) if errors_file else None
+        if error_writer:
+            error_writer.writerow(['line', 'chassis_number', 'field', 'error'])
+
+        def on_error(line, chassis_number, errors):
+            for field, messages in errors.items():
+                for message in messages:
+                    if error_writer:
+                        error_writer.writerow([line, chassis_number or '', field, message])
+                    else:
+                        self.stderr.write(f"line {line} ({chassis_number or '?'}): {field}: {message}")
+
+        def on_progress(rows, counts):
+            self.stdout.write(
+                f"{rows} rows: {counts['created']} created, {counts['updated']} updated, "
+                f"{counts['unchanged']} unchanged, {counts['error']} rejected"
+            )
+
+        source = sys.stdin if options['path'] == '-' else None
+        try:
+            if source is None:
+                source = open(options['path'], newline='', encoding='utf-8-sig')
+            counts = import_vehicles(
+                source,
+                username=options['user'],
+                dry_run=options['dry_run'],
+                chunk_size=options['chunk_size'],
+                on_error=on_error,
+                on_progress=on_progress,
+            )
+        except (OSError, CSVFormatError) as e:
+            raise CommandError(str(e))
+        finally:
+            if source is not None and source is not sys.stdin:
+                source.close()
+            if errors_file:
+                errors_file.close()
+
+        summary = (
+            f"{counts['rows']} rows: {counts['created']} created, {counts['updated']} updated, "
+            f"{counts['unchanged']} unchanged, {counts['error']} rejected"
+        )
+        if options['dry_run']:
+            summary = f"Dry run, nothing saved. {summary}"
+        style = self.style.SUCCESS if not counts['error'] else self.style.WARNING
+        self.stdout.write(style(summary))
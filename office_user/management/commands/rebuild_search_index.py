@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from office_user import search
+
+class Command(BaseCommand):
+    help = 'Regenerates the full-text vehicle search index'
+
+    def handle(self, *args, **options):
+        if not search.is_supported():
+            self.stdout.write(self.style.WARNING("Full-text search index requires SQLite FTS5; nothing to do"))
+            return
+        indexed = search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} vehicles"))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from office_user.models import VehicleListing, VehicleMaster
+from office_user.serializers import refresh_listings
+
+class Command(BaseCommand):
+    help = 'Regenerates the denormalized VehicleListing rows for the whole fleet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Vehicles serialized per batch')
+
+    def handle(self, *args, **options):
+        written = refresh_listings(chunk_size=options['chunk_size'])
+        # Listings cascade with their vehicle, but clear anything left behind regardless
+        orphans, _ = VehicleListing.objects.exclude(vehicle__in=VehicleMaster.objects.all()).delete()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} vehicle listings ({orphans} orphans removed)"))
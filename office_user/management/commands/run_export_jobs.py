@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+from office_user import export_jobs
+
+class Command(BaseCommand):
+    help = 'Runs queued export jobs (for EXPORT_JOBS_IN_PROCESS = False deployments)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the queued jobs, then exit')
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds between polls when idle')
+
+    def handle(self, *args, **options):
+        while True:
+            failed = export_jobs.fail_stale_jobs()
+            if failed:
+                self.stdout.write(self.style.WARNING(f"Marked {failed} stale export jobs as failed"))
+            ran = 0
+            while export_jobs.run_next_job():
+                ran += 1
+            if ran:
+                self.stdout.write(self.style.SUCCESS(f"Ran {ran} export jobs"))
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from office_user import history
+
+class Command(BaseCommand):
+    help = 'Checkpoints vehicles with many changes since their last snapshot, to bound "as of" replays'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=history.SNAPSHOT_INTERVAL,
+                            help='Snapshot vehicles with at least this many changes since their last snapshot')
+        parser.add_argument('--all', action='store_true', help='Snapshot every vehicle that has any change')
+
+    def handle(self, *args, **options):
+        interval = 1 if options['all'] else options['interval']
+        if interval < 1:
+            raise CommandError('--interval must be at least 1')
+        due = history.vehicles_due_for_snapshot(interval)
+        written = history.take_snapshots(due)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} vehicle snapshots"))
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office_user', '0011_dataversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VehicleListing',
+            fields=[
+                ('vehicle', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='listing', serialize=False, to='office_user.vehiclemaster')),
+                ('data', models.JSONField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Vehicle listing',
+                'verbose_name_plural': 'Vehicle listings',
+            },
+        ),
+    ]
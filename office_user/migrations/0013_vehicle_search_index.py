@@ -0,0 +1,64 @@
+from django.db import migrations
+
+SEARCH_TABLE = "office_user_vehiclesearch"
+
+LOOKUP_NAME_COLUMNS = [
+    "vehicle_capacity__name",
+    "vehicle_type__name",
+    "tote_capacity__name",
+    "status__name",
+    "vehicle_concept__name",
+    "make__name",
+    "gps__name",
+    "branding_status__name",
+    "tail_lift_brand__name",
+]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+        "chassis_number, plate_number, tc_owner, salik_account_no, salik_tag_no, "
+        "darb_ac_no, remarks, lookups, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4')"
+    )
+
+    VehicleMaster = apps.get_model("office_user", "VehicleMaster")
+    through = VehicleMaster.emirates_permit.through
+    permits = {}
+    for vehicle_id, name in through.objects.values_list("vehiclemaster_id", "emirate__name"):
+        permits.setdefault(vehicle_id, []).append(name)
+
+    rows = []
+    for row in VehicleMaster.objects.values_list(
+        "chassis_number", "plate_number", "tc_owner", "salik_account_no", "salik_tag_no",
+        "darb_ac_no", "remarks", *LOOKUP_NAME_COLUMNS,
+    ).iterator():
+        names = [n for n in row[7:] if n] + permits.get(row[0], [])
+        rows.append([value or "" for value in row[:7]] + [" ".join(names)])
+    if rows:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (chassis_number, plate_number, tc_owner, salik_account_no, "
+                "salik_tag_no, darb_ac_no, remarks, lookups) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+                rows,
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office_user', '0012_vehiclelisting'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:48
+
+from datetime import datetime
+
+from django.db import migrations, models
+from django.utils import timezone
+
+BATCH_SIZE = 500
+
+
+def changelog_to_changesets(apps, schema_editor):
+    # Field rows written by one save share chassis, plate, user, date and time
+    ChangeLog = apps.get_model("office_user", "ChangeLog")
+    ChangeSet = apps.get_model("office_user", "ChangeSet")
+    rows = ChangeLog.objects.order_by("date", "time", "chassis_number", "plate_number", "username", "id")
+
+    batch, key, current = [], None, None
+    for log in rows.iterator(chunk_size=BATCH_SIZE):
+        log_key = (log.date, log.time, log.chassis_number, log.plate_number, log.username)
+        if log_key != key:
+            if len(batch) >= BATCH_SIZE:
+                ChangeSet.objects.bulk_create(batch)
+                batch = []
+            key = log_key
+            current = ChangeSet(
+                timestamp=timezone.make_aware(datetime.combine(log.date, log.time)),
+                chassis_number=log.chassis_number or "",
+                plate_number=log.plate_number,
+                username=log.username,
+                changes={},
+            )
+            batch.append(current)
+        if log.field_name in current.changes:
+            # Saved again within the same second: keep the first old value
+            # and the last new one (rows are in id order within a group)
+            current.changes[log.field_name][1] = log.new_value or ""
+        else:
+            current.changes[log.field_name] = [log.old_value or "", log.new_value or ""]
+    ChangeSet.objects.bulk_create(batch)
+
+
+def changesets_to_changelog(apps, schema_editor):
+    ChangeLog = apps.get_model("office_user", "ChangeLog")
+    ChangeSet = apps.get_model("office_user", "ChangeSet")
+    batch = []
+    for changeset in ChangeSet.objects.order_by("timestamp", "id").iterator(chunk_size=BATCH_SIZE):
+        local = timezone.localtime(changeset.timestamp)
+        for field, (old, new) in changeset.changes.items():
+            batch.append(ChangeLog(
+                date=local.date(),
+                time=local.time().replace(microsecond=0),
+                chassis_number=changeset.chassis_number,
+                plate_number=changeset.plate_number,
+                field_name=field,
+                old_value=old,
+                new_value=new,
+                username=changeset.username,
+            ))
+        if len(batch) >= BATCH_SIZE:
+            ChangeLog.objects.bulk_create(batch)
+            batch = []
+    ChangeLog.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office_user', '0013_vehicle_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(db_index=True)),
+                ('chassis_number', models.CharField(max_length=100)),
+                ('plate_number', models.CharField(blank=True, max_length=50, null=True)),
+                ('username', models.CharField(blank=True, max_length=150, null=True)),
+                ('changes', models.JSONField()),
+            ],
+            options={
+                'verbose_name': 'Change set',
+                'verbose_name_plural': 'Change sets',
+                'db_table': 'change_set',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='changeset',
+            index=models.Index(fields=['chassis_number', 'timestamp'], name='change_set_vehicle_idx'),
+        ),
+        migrations.RunPython(changelog_to_changesets, changesets_to_changelog),
+        migrations.DeleteModel(
+            name='ChangeLog',
+        ),
+    ]
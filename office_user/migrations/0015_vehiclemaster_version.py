@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office_user', '0014_changeset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vehiclemaster',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office_user', '0016_exportjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='changeset',
+            index=models.Index(fields=['plate_number', 'timestamp'], name='change_set_plate_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='changeset',
+            index=models.Index(fields=['username', 'timestamp'], name='change_set_user_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office_user', '0017_changeset_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VehicleSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chassis_number', models.CharField(max_length=100)),
+                ('timestamp', models.DateTimeField()),
+                ('changeset_id', models.BigIntegerField()),
+                ('data', models.JSONField()),
+            ],
+            options={
+                'verbose_name': 'Vehicle snapshot',
+                'verbose_name_plural': 'Vehicle snapshots',
+                'db_table': 'vehicle_snapshot',
+                'indexes': [models.Index(fields=['chassis_number', 'timestamp'], name='vehicle_snapshot_idx')],
+            },
+        ),
+    ]
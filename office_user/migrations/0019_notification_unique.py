@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:44
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def drop_duplicate_notifications(apps, schema_editor):
+    # Keep the oldest notification of each (user, vehicle, type)
+    Notification = apps.get_model("office_user", "Notification")
+    duplicated = (
+        Notification.objects.order_by()
+        .values("user_id", "vehicle_id", "notification_type")
+        .annotate(keep=Min("id"), copies=Count("id"))
+        .filter(copies__gt=1)
+    )
+    for group in duplicated:
+        Notification.objects.filter(
+            user_id=group["user_id"],
+            vehicle_id=group["vehicle_id"],
+            notification_type=group["notification_type"],
+        ).exclude(id=group["keep"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office_user', '0018_vehiclesnapshot'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_notifications, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(fields=('user', 'vehicle', 'notification_type'), name='notification_once_idx'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+BATCH_SIZE = 500
+
+EXPIRY_FIELDS = {
+    "truck": "truck_registration_expiry_date",
+    "insurance": "insurance_registration_expiry_date",
+    "mulkia": "mulkia_registration_expiry_date",
+    "permit": "permit_registration_expiry_date",
+}
+
+
+def build_expiry_events(apps, schema_editor):
+    VehicleMaster = apps.get_model("office_user", "VehicleMaster")
+    ExpiryEvent = apps.get_model("office_user", "ExpiryEvent")
+    now = timezone.now()
+    rows = VehicleMaster.objects.order_by("pk").values_list("pk", *EXPIRY_FIELDS.values())
+    batch = []
+    for chassis_number, *dates in rows.iterator(chunk_size=BATCH_SIZE):
+        for notification_type, expires_on in zip(EXPIRY_FIELDS, dates):
+            if expires_on is not None:
+                batch.append(ExpiryEvent(
+                    vehicle_id=chassis_number,
+                    notification_type=notification_type,
+                    expires_on=expires_on,
+                    changed_at=now,
+                ))
+        if len(batch) >= BATCH_SIZE:
+            ExpiryEvent.objects.bulk_create(batch)
+            batch = []
+    ExpiryEvent.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office_user', '0019_notification_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpiryRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField()),
+                ('checked_on', models.DateField()),
+                ('incremental', models.BooleanField()),
+                ('created', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Expiry run',
+                'verbose_name_plural': 'Expiry runs',
+                'db_table': 'expiry_run',
+            },
+        ),
+        migrations.CreateModel(
+            name='ExpiryEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('notification_type', models.CharField(choices=[('insurance', 'Insurance Expiry'), ('mulkia', 'Mulkia Expiry'), ('permit', 'Permit Expiry'), ('truck', 'Truck Registration Expiry')], max_length=20)),
+                ('expires_on', models.DateField()),
+                ('changed_at', models.DateTimeField()),
+                ('vehicle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='expiry_events', to='office_user.vehiclemaster')),
+            ],
+            options={
+                'verbose_name': 'Expiry event',
+                'verbose_name_plural': 'Expiry events',
+                'db_table': 'expiry_event',
+                'indexes': [models.Index(fields=['notification_type', 'expires_on'], name='expiry_event_date_idx'), models.Index(fields=['expires_on'], name='expiry_event_calendar_idx'), models.Index(fields=['changed_at'], name='expiry_event_changed_idx')],
+                'constraints': [models.UniqueConstraint(fields=('vehicle', 'notification_type'), name='expiry_event_document_idx')],
+            },
+        ),
+        migrations.RunPython(build_expiry_events, migrations.RunPython.noop),
+    ]
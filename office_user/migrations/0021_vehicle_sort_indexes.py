@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office_user', '0020_expiryevent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='vehiclemaster',
+            index=models.Index(fields=['truck_reg_date', 'chassis_number'], name='vm_truck_reg_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehiclemaster',
+            index=models.Index(fields=['truck_registration_expiry_date', 'chassis_number'], name='vm_truck_exp_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehiclemaster',
+            index=models.Index(fields=['insurance_registration_date', 'chassis_number'], name='vm_ins_reg_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehiclemaster',
+            index=models.Index(fields=['insurance_registration_expiry_date', 'chassis_number'], name='vm_ins_exp_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehiclemaster',
+            index=models.Index(fields=['mulkia_registration_date', 'chassis_number'], name='vm_mulkia_reg_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehiclemaster',
+            index=models.Index(fields=['mulkia_registration_expiry_date', 'chassis_number'], name='vm_mulkia_exp_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehiclemaster',
+            index=models.Index(fields=['permit_registration_date', 'chassis_number'], name='vm_permit_reg_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehiclemaster',
+            index=models.Index(fields=['permit_registration_expiry_date', 'chassis_number'], name='vm_permit_exp_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehiclemaster',
+            index=models.Index(fields=['tl_no', 'chassis_number'], name='vm_tl_no_sort_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vehiclemaster',
+            index=models.Index(fields=['tc_no', 'chassis_number'], name='vm_tc_no_sort_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:25
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('office_user', '0021_vehicle_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='changeset',
+            name='change_set_plate_idx',
+        ),
+        migrations.AddIndex(
+            model_name='changeset',
+            index=models.Index(django.db.models.functions.text.Upper('chassis_number'), models.F('timestamp'), name='change_set_chassis_ci_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='changeset',
+            index=models.Index(django.db.models.functions.text.Upper('plate_number'), models.F('timestamp'), name='change_set_plate_ci_idx'),
+        ),
+    ]
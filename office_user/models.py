@@ -1,5 +1,10 @@
-from django.db import models
+from collections import namedtuple
+
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Upper
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class VehicleCapacity(models.Model):
     name = models.CharField(max_length=50, unique=True)
@@ -101,10 +106,30 @@ class TailLiftBrand(models.Model):
     def __str__(self):
         return self.name
 
+class VersionConflict(Exception):
+    """A conditional vehicle update lost to a concurrent write."""
+
+    def __init__(self, chassis_number, version):
+        super().__init__(f"{chassis_number} was modified concurrently (now at version {version})")
+        self.version = version
+
 class VehicleMaster(models.Model):
     class Meta:
         verbose_name = "Vehicle master"
         verbose_name_plural = "Vehicle masters"
+        # (sort column, chassis_number) for the list API's keyset pages
+        indexes = [
+            models.Index(fields=["truck_reg_date", "chassis_number"], name="vm_truck_reg_sort_idx"),
+            models.Index(fields=["truck_registration_expiry_date", "chassis_number"], name="vm_truck_exp_sort_idx"),
+            models.Index(fields=["insurance_registration_date", "chassis_number"], name="vm_ins_reg_sort_idx"),
+            models.Index(fields=["insurance_registration_expiry_date", "chassis_number"], name="vm_ins_exp_sort_idx"),
+            models.Index(fields=["mulkia_registration_date", "chassis_number"], name="vm_mulkia_reg_sort_idx"),
+            models.Index(fields=["mulkia_registration_expiry_date", "chassis_number"], name="vm_mulkia_exp_sort_idx"),
+            models.Index(fields=["permit_registration_date", "chassis_number"], name="vm_permit_reg_sort_idx"),
+            models.Index(fields=["permit_registration_expiry_date", "chassis_number"], name="vm_permit_exp_sort_idx"),
+            models.Index(fields=["tl_no", "chassis_number"], name="vm_tl_no_sort_idx"),
+            models.Index(fields=["tc_no", "chassis_number"], name="vm_tc_no_sort_idx"),
+        ]
 
     chassis_number = models.CharField(max_length=100, primary_key=True, unique=True)
     plate_number = models.CharField(max_length=50, unique=True)
@@ -138,33 +163,190 @@ class VehicleMaster(models.Model):
     tail_lift_brand = models.ForeignKey(TailLiftBrand, on_delete=models.CASCADE)
     remarks = models.TextField(blank=True, null=True)
     truck_photos = models.ImageField(upload_to='images/')
+    # Bumped on every update; writes are conditional on the version loaded
+    version = models.PositiveIntegerField(default=1)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Raw column values as loaded, for dirty tracking
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def _raw_value(self, field):
+        value = getattr(self, field.attname)
+        if isinstance(field, models.FileField):
+            return value.name if value else ""
+        return value
+
+    def dirty_fields(self):
+        """
+        {field name: value as loaded} for every column changed since the row
+        was loaded or last saved. Columns that were never loaded count as
+        changed once assigned.
+        """
+        loaded = getattr(self, "_loaded_values", {})
+        dirty = {}
+        for field in self._meta.concrete_fields:
+            if field.primary_key or field.name == "version":
+                continue
+            if field.attname in loaded:
+                if self._raw_value(field) != loaded[field.attname]:
+                    dirty[field.name] = loaded[field.attname]
+            elif field.attname in self.__dict__:
+                dirty[field.name] = None
+        return dirty
+
+    def save(self, *args, **kwargs):
+        if self._state.adding or not hasattr(self, "_loaded_values"):
+            super().save(*args, **kwargs)
+            self._mark_clean()
+            return
+
+        # Existing rows only write the columns that changed, or nothing at
+        # all, and only if nobody else updated the row since it was loaded.
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None:
+            update_fields = list(self.dirty_fields())
+            if not update_fields:
+                return
+        expected = self._loaded_values.get("version", self.version)
+        self.version = expected + 1
+        kwargs["update_fields"] = {*update_fields, "version"}
+        self._expected_version = expected
+        try:
+            super().save(*args, **kwargs)
+        except Exception:
+            self.version = expected
+            raise
+        finally:
+            self._expected_version = None
+        self._mark_clean()
+
+    def bump_version(self):
+        """Record a change made outside the row itself, e.g. to its permits."""
+        self.save(update_fields=["version"])
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        expected = getattr(self, "_expected_version", None)
+        if expected is None:
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+        updated = super()._do_update(
+            base_qs.filter(version=expected), using, pk_val, values, update_fields, forced_update
+        )
+        if not updated:
+            current = base_qs.filter(pk=pk_val).values_list("version", flat=True).first()
+            if current is not None:
+                raise VersionConflict(self.pk, current)
+        return updated
+
+    def _mark_clean(self):
+        self._loaded_values = {
+            f.attname: self._raw_value(f) for f in self._meta.concrete_fields if f.attname in self.__dict__
+        }
 
     def __str__(self):
         return self.chassis_number
 
-class ChangeLog(models.Model):
+class VehicleListing(models.Model):
+    """
+    Denormalized read model: the fully serialized list representation of a
+    vehicle, refreshed whenever the vehicle, its permits or a lookup name
+    it references changes. List reads come from here instead of joining
+    every lookup table and prefetching permits.
+    """
     class Meta:
-        verbose_name = "Change log"
-        verbose_name_plural = "Change logs"
-        db_table = "change_log"
+        verbose_name = "Vehicle listing"
+        verbose_name_plural = "Vehicle listings"
+
+    vehicle = models.OneToOneField(VehicleMaster, on_delete=models.CASCADE, primary_key=True, related_name="listing")
+    data = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True)
 
-    date = models.DateField()
-    time = models.TimeField()
-    chassis_number = models.CharField(max_length=100, blank=True, null=True)
+    def __str__(self):
+        return self.vehicle_id
+
+# One field-level row of a ChangeSet, in the shape the change log pages render
+ChangeEntry = namedtuple(
+    "ChangeEntry",
+    ["date", "time", "chassis_number", "plate_number", "field_name", "old_value", "new_value", "username"],
+)
+
+class ChangeSet(models.Model):
+    """
+    One row per saved vehicle edit: who made it, when, and the changed
+    fields as {field: [old, new]}.
+    """
+    class Meta:
+        verbose_name = "Change set"
+        verbose_name_plural = "Change sets"
+        db_table = "change_set"
+        indexes = [
+            models.Index(fields=["chassis_number", "timestamp"], name="change_set_vehicle_idx"),
+            # Case-insensitive prefix filters on the change log compare UPPER()
+            models.Index(Upper("chassis_number"), F("timestamp"), name="change_set_chassis_ci_idx"),
+            models.Index(Upper("plate_number"), F("timestamp"), name="change_set_plate_ci_idx"),
+            models.Index(fields=["username", "timestamp"], name="change_set_user_idx"),
+        ]
+
+    timestamp = models.DateTimeField(db_index=True)
+    chassis_number = models.CharField(max_length=100)
     plate_number = models.CharField(max_length=50, blank=True, null=True)
-    field_name = models.CharField(max_length=100)
-    old_value = models.TextField(blank=True, null=True)
-    new_value = models.TextField(blank=True, null=True)
     username = models.CharField(max_length=150, blank=True, null=True)
+    changes = models.JSONField()
+
+    def entries(self):
+        local = timezone.localtime(self.timestamp)
+        return [
+            ChangeEntry(
+                local.date(),
+                local.time().replace(microsecond=0),
+                self.chassis_number,
+                self.plate_number,
+                field,
+                old,
+                new,
+                self.username,
+            )
+            for field, (old, new) in self.changes.items()
+        ]
+
+    def __str__(self):
+        return f"{self.timestamp} {self.chassis_number}"
+
+class VehicleSnapshot(models.Model):
+    """
+    Checkpoint of a vehicle's logged fields (as change-log display values)
+    right after the ChangeSet changeset_id, stamped with that ChangeSet's
+    timestamp. Point-in-time reads start from the nearest later checkpoint
+    instead of the current row, so they never replay more than the changes
+    between two checkpoints.
+    """
+    class Meta:
+        verbose_name = "Vehicle snapshot"
+        verbose_name_plural = "Vehicle snapshots"
+        db_table = "vehicle_snapshot"
+        indexes = [
+            models.Index(fields=["chassis_number", "timestamp"], name="vehicle_snapshot_idx"),
+        ]
+
+    chassis_number = models.CharField(max_length=100)
+    timestamp = models.DateTimeField()
+    changeset_id = models.BigIntegerField()
+    data = models.JSONField()
 
     def __str__(self):
-        return f"{self.date} {self.time} {self.field_name}"
+        return f"{self.chassis_number} @ {self.timestamp}"
 
 class Notification(models.Model):
     class Meta:
         verbose_name = "Notification"
         verbose_name_plural = "Notifications"
         ordering = ['-created_at']
+        constraints = [
+            # One alert per user, vehicle and document; check_expirations relies on it
+            models.UniqueConstraint(fields=['user', 'vehicle', 'notification_type'], name='notification_once_idx'),
+        ]
 
     STATUS_CHOICES = [
         ('unread', 'Unread'),
@@ -203,3 +385,148 @@ class UserNotificationSettings(models.Model):
 
     def __str__(self):
         return f"Notification settings for {self.user.username}"
+
+class ExpiryEvent(models.Model):
+    """
+    One vehicle document's expiry date, derived from the vehicle's expiry
+    columns and kept in sync by the vehicles_changed signal. Indexed by
+    date, so "what expires between X and Y" is a range seek rather than a
+    scan of four columns over the fleet. changed_at is the last time the
+    date was set, so incremental notification runs can pick up edits.
+    """
+    class Meta:
+        verbose_name = "Expiry event"
+        verbose_name_plural = "Expiry events"
+        db_table = "expiry_event"
+        constraints = [
+            models.UniqueConstraint(fields=["vehicle", "notification_type"], name="expiry_event_document_idx"),
+        ]
+        indexes = [
+            models.Index(fields=["notification_type", "expires_on"], name="expiry_event_date_idx"),
+            models.Index(fields=["expires_on"], name="expiry_event_calendar_idx"),
+            models.Index(fields=["changed_at"], name="expiry_event_changed_idx"),
+        ]
+
+    vehicle = models.ForeignKey(VehicleMaster, on_delete=models.CASCADE, related_name="expiry_events")
+    notification_type = models.CharField(max_length=20, choices=Notification.NOTIFICATION_TYPE_CHOICES)
+    expires_on = models.DateField()
+    changed_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.vehicle_id} {self.notification_type} expires {self.expires_on}"
+
+class ExpiryRun(models.Model):
+    """A check_expirations run; the latest one bounds the next incremental run."""
+    class Meta:
+        verbose_name = "Expiry run"
+        verbose_name_plural = "Expiry runs"
+        db_table = "expiry_run"
+
+    started_at = models.DateTimeField()
+    checked_on = models.DateField()
+    incremental = models.BooleanField()
+    created = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{'Incremental' if self.incremental else 'Full'} expiry run {self.started_at}"
+
+class DataVersion(models.Model):
+    """
+    Monotonic change counter for a data scope. The "fleet" scope is bumped on
+    every write to vehicles, their permits and the lookup tables, and is used
+    to answer conditional GETs without reading any vehicle rows. The
+    "lookups" scope is bumped on lookup table writes only and tells each
+    process when to reload its lookup registry. Bumps land right after the
+    write commits, outside its transaction; vehicle writes bump the fleet
+    again once their derived data has been rebuilt (see signals.py).
+    """
+    class Meta:
+        verbose_name = "Data version"
+        verbose_name_plural = "Data versions"
+
+    FLEET = "fleet"
+    LOOKUPS = "lookups"
+
+    name = models.CharField(max_length=50, primary_key=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def current(cls, name=FLEET):
+        obj, created = cls.objects.get_or_create(name=name)
+        return obj
+
+    @classmethod
+    def bump(cls, name=FLEET):
+        updated = cls.objects.filter(name=name).update(version=F("version") + 1, updated_at=timezone.now())
+        if not updated:
+            cls.objects.get_or_create(name=name, defaults={"version": 1})
+
+    @classmethod
+    def bump_on_commit(cls, name=FLEET):
+        """
+        Bump once the current transaction commits (at once in autocommit).
+        Write transactions never lock the shared counter row, so concurrent
+        writers do not queue behind each other on it.
+        """
+        transaction.on_commit(lambda: cls.bump(name))
+
+    def __str__(self):
+        return f"{self.name} v{self.version}"
+
+class ExportJob(models.Model):
+    """
+    A background export of the vehicles or the change log to a gzip file
+    under settings.EXPORT_ROOT. data_version records what the artifact
+    covers (the fleet version for vehicles, the last ChangeSet id for the
+    change log) so a finished artifact can be served again until it changes.
+    """
+    class Meta:
+        verbose_name = "Export job"
+        verbose_name_plural = "Export jobs"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=["kind", "format", "data_version"], name="export_job_artifact_idx"),
+        ]
+
+    VEHICLES = "vehicles"
+    CHANGE_LOG = "change_log"
+    KIND_CHOICES = [
+        (VEHICLES, "Vehicles"),
+        (CHANGE_LOG, "Change log"),
+    ]
+
+    CSV = "csv"
+    NDJSON = "ndjson"
+    FORMAT_CHOICES = [
+        (CSV, "CSV"),
+        (NDJSON, "NDJSON"),
+    ]
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    data_version = models.PositiveBigIntegerField()
+    rows_total = models.PositiveIntegerField(null=True, blank=True)
+    rows_done = models.PositiveIntegerField(default=0)
+    file_name = models.CharField(max_length=255, blank=True)
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.kind}.{self.format} v{self.data_version} ({self.status})"
@@ -0,0 +1,142 @@
+"""
+Full-text search over vehicles, backed by an SQLite FTS5 table.
+
+The index holds one row per vehicle with its searchable columns and the
+names of every lookup it references. It is kept in sync from the
+vehicles_changed signal and VehicleMaster deletes; rebuild_search_index
+regenerates it from scratch. On other database backends search falls
+back to the list API's icontains filter.
+"""
+import re
+
+from django.db import connection
+
+from .models import VehicleMaster
+
+SEARCH_TABLE = "office_user_vehiclesearch"
+
+SEARCH_COLUMNS = [
+    "chassis_number",
+    "plate_number",
+    "tc_owner",
+    "salik_account_no",
+    "salik_tag_no",
+    "darb_ac_no",
+    "remarks",
+    "lookups",
+]
+
+# bm25 column weights, in SEARCH_COLUMNS order: identifiers rank highest
+SEARCH_WEIGHTS = [10.0, 10.0, 3.0, 4.0, 4.0, 4.0, 1.0, 1.0]
+
+LOOKUP_NAME_COLUMNS = [
+    "vehicle_capacity__name",
+    "vehicle_type__name",
+    "tote_capacity__name",
+    "status__name",
+    "vehicle_concept__name",
+    "make__name",
+    "gps__name",
+    "branding_status__name",
+    "tail_lift_brand__name",
+]
+
+INDEX_CHUNK_SIZE = 500
+
+def is_supported():
+    return connection.vendor == "sqlite"
+
+def _index_rows(chassis_numbers):
+    vehicles = VehicleMaster.objects.filter(pk__in=chassis_numbers).values_list(
+        *SEARCH_COLUMNS[:-1], *LOOKUP_NAME_COLUMNS
+    )
+    through = VehicleMaster.emirates_permit.through
+    permits = {}
+    for vehicle_id, name in through.objects.filter(vehiclemaster_id__in=chassis_numbers).values_list(
+        "vehiclemaster_id", "emirate__name"
+    ):
+        permits.setdefault(vehicle_id, []).append(name)
+
+    searchable = len(SEARCH_COLUMNS) - 1
+    for row in vehicles:
+        names = [n for n in row[searchable:] if n] + permits.get(row[0], [])
+        yield [value or "" for value in row[:searchable]] + [" ".join(names)]
+
+def remove_vehicles(chassis_numbers):
+    if not is_supported():
+        return
+    chassis_numbers = list(chassis_numbers)
+    with connection.cursor() as cursor:
+        for start in range(0, len(chassis_numbers), INDEX_CHUNK_SIZE):
+            chunk = chassis_numbers[start:start + INDEX_CHUNK_SIZE]
+            phrases = " OR ".join(_phrase(c) for c in chunk)
+            # MATCH narrows through the FTS index; the IN check makes it exact
+            cursor.execute(
+                f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN ("
+                f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s"
+                f") AND chassis_number IN ({', '.join(['%s'] * len(chunk))})",
+                [f"chassis_number:({phrases})", *chunk],
+            )
+
+def index_vehicles(chassis_numbers):
+    """(Re)index the given vehicles; vehicles that no longer exist are dropped."""
+    if not is_supported():
+        return
+    chassis_numbers = list(chassis_numbers)
+    for start in range(0, len(chassis_numbers), INDEX_CHUNK_SIZE):
+        chunk = chassis_numbers[start:start + INDEX_CHUNK_SIZE]
+        remove_vehicles(chunk)
+        _insert_rows(_index_rows(chunk))
+
+def rebuild_index(chunk_size=INDEX_CHUNK_SIZE):
+    """Regenerate the whole index. Returns the number of vehicles indexed."""
+    if not is_supported():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+    indexed = 0
+    qs = VehicleMaster.objects.order_by("pk").values_list("pk", flat=True)
+    page = qs
+    while True:
+        chunk = list(page[:chunk_size])
+        if chunk:
+            _insert_rows(_index_rows(chunk))
+            indexed += len(chunk)
+        if len(chunk) < chunk_size:
+            return indexed
+        page = qs.filter(pk__gt=chunk[-1])
+
+def _insert_rows(rows):
+    placeholders = ", ".join(["%s"] * len(SEARCH_COLUMNS))
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} ({', '.join(SEARCH_COLUMNS)}) VALUES ({placeholders})",
+            list(rows),
+        )
+
+def _phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def build_match_query(term):
+    """
+    Turn free text into an FTS5 query: every word must match as a prefix,
+    so "dxb 123" finds plate "DXB-12345". Returns None if nothing is searchable.
+    """
+    words = re.findall(r"\w+", term or "")
+    if not words:
+        return None
+    return " ".join(f"{_phrase(word)}*" for word in words)
+
+def search_vehicles(term, limit, offset=0):
+    """Return chassis numbers matching term, best match first."""
+    match = build_match_query(term)
+    if match is None:
+        return []
+    weights = ", ".join(str(w) for w in SEARCH_WEIGHTS)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT chassis_number FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s "
+            f"ORDER BY bm25({SEARCH_TABLE}, {weights}), chassis_number LIMIT %s OFFSET %s",
+            [match, limit, offset],
+        )
+        return [row[0] for row in cursor.fetchall()]
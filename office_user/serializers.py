@@ -0,0 +1,175 @@
+from collections import namedtuple
+
+from .lookups import get_registry
+from .models import VehicleMaster, VehicleListing
+
+def file_url_or_none(field_file):
+    try:
+        return field_file.url if field_file else None
+    except Exception:
+        return None
+
+def storage_url_or_none(storage, name):
+    try:
+        return storage.url(name) if name else None
+    except Exception:
+        return None
+
+def _iso_or_none(value):
+    return value.isoformat() if value else None
+
+def _lookup_ref(v: VehicleMaster, name, model):
+    # Names come from the in-process lookup registry, so no join is needed
+    fk_id = getattr(v, f"{name}_id")
+    return {"id": fk_id, "name": get_registry().name(model, fk_id) if fk_id else None}
+
+# One entry per output key: how to serialize it from an instance, which
+# columns it needs (for ?fields=), and which raw column plus encoder produce
+# it from a values() row (for ?format=compact).
+VehicleField = namedtuple("VehicleField", ["serialize", "columns", "column", "encode"])
+
+def _attr_field(name):
+    return VehicleField(lambda v: getattr(v, name), [name], name, None)
+
+def _date_field(name):
+    return VehicleField(lambda v: _iso_or_none(getattr(v, name)), [name], name, _iso_or_none)
+
+def _file_field(name):
+    storage = VehicleMaster._meta.get_field(name).storage
+    return VehicleField(
+        lambda v: file_url_or_none(getattr(v, name)),
+        [name],
+        name,
+        lambda value: storage_url_or_none(storage, value),
+    )
+
+def _lookup_field(name):
+    model = VehicleMaster._meta.get_field(name).related_model
+    return VehicleField(lambda v: _lookup_ref(v, name, model), [name], f"{name}_id", None)
+
+VEHICLE_FIELDS = {
+    "chassis_number": _attr_field("chassis_number"),
+    "plate_number": _attr_field("plate_number"),
+    "vehicle_capacity": _lookup_field("vehicle_capacity"),
+    "vehicle_type": _lookup_field("vehicle_type"),
+    "tote_capacity": _lookup_field("tote_capacity"),
+    "status": _lookup_field("status"),
+    "vehicle_concept": _lookup_field("vehicle_concept"),
+    "make": _lookup_field("make"),
+    "truck_reg_date": _date_field("truck_reg_date"),
+    "truck_registration_expiry_date": _date_field("truck_registration_expiry_date"),
+    "insurance_document_url": _file_field("insurance_document"),
+    "insurance_registration_date": _date_field("insurance_registration_date"),
+    "insurance_registration_expiry_date": _date_field("insurance_registration_expiry_date"),
+    "mulkia_registration_date": _date_field("mulkia_registration_date"),
+    "mulkia_registration_expiry_date": _date_field("mulkia_registration_expiry_date"),
+    "mulkia_document_url": _file_field("mulkia_document"),
+    "emirates_permit": VehicleField(
+        lambda v: [{"id": e.id, "name": e.name} for e in v.emirates_permit.all()],
+        [],
+        None,
+        None,
+    ),
+    "permit_registration_date": _date_field("permit_registration_date"),
+    "permit_registration_expiry_date": _date_field("permit_registration_expiry_date"),
+    "permit_document_url": _file_field("permit_document"),
+    "tl_no": _attr_field("tl_no"),
+    "tc_no": _attr_field("tc_no"),
+    "tc_owner": _attr_field("tc_owner"),
+    "salik_account_no": _attr_field("salik_account_no"),
+    "salik_tag_no": _attr_field("salik_tag_no"),
+    "darb_ac_no": _attr_field("darb_ac_no"),
+    "gps": _lookup_field("gps"),
+    "branding_status": _lookup_field("branding_status"),
+    "lift_gate": _attr_field("lift_gate"),
+    "tail_lift_brand": _lookup_field("tail_lift_brand"),
+    "remarks": _attr_field("remarks"),
+    "truck_photos_url": _file_field("truck_photos"),
+    "version": _attr_field("version"),
+}
+
+def serialize_vehicle(v: VehicleMaster, fields=None):
+    return {name: VEHICLE_FIELDS[name].serialize(v) for name in (fields or VEHICLE_FIELDS)}
+
+def vehicle_queryset(fields=None, extra_columns=()):
+    """
+    Base queryset for serializing vehicles. With a sparse field list only the
+    needed columns are selected; the emirates prefetch is skipped unless
+    emirates_permit was requested. Lookup names are resolved from the lookup
+    registry rather than joined.
+    """
+    if fields is None:
+        return VehicleMaster.objects.prefetch_related("emirates_permit")
+
+    columns = ["chassis_number", *extra_columns]
+    for name in fields:
+        columns.extend(VEHICLE_FIELDS[name].columns)
+    qs = VehicleMaster.objects.only(*dict.fromkeys(columns))
+    if "emirates_permit" in fields:
+        qs = qs.prefetch_related("emirates_permit")
+    return qs
+
+def load_vehicle(chassis_number):
+    """
+    Fetch one vehicle with its permits prefetched: two queries, after which
+    serialization and change tracking need no further database access
+    (lookup names come from the registry). No lock is taken; saves are
+    conditional on the loaded version instead. Returns None if the vehicle
+    does not exist.
+    """
+    return vehicle_queryset().filter(pk=chassis_number).first()
+
+# -------------------------------
+# VehicleListing read model
+# -------------------------------
+
+LISTING_CHUNK_SIZE = 500
+
+def refresh_listings(chassis_numbers=None, chunk_size=LISTING_CHUNK_SIZE):
+    """
+    Re-serialize vehicles into VehicleListing, chunk by chunk. None refreshes
+    the whole fleet. Returns the number of listings written.
+    """
+    qs = vehicle_queryset().order_by("pk")
+    if chassis_numbers is not None:
+        qs = qs.filter(pk__in=list(chassis_numbers))
+
+    written = 0
+    page = qs
+    while True:
+        chunk = list(page[:chunk_size])
+        if chunk:
+            _store_listings(chunk)
+            written += len(chunk)
+        if len(chunk) < chunk_size:
+            return written
+        page = qs.filter(pk__gt=chunk[-1].pk)
+
+def _store_listings(vehicles):
+    # Listings outlive the registry's check interval, so never store stale names
+    get_registry(max_age=0)
+    listings = [VehicleListing(vehicle=v, data=serialize_vehicle(v)) for v in vehicles]
+    VehicleListing.objects.bulk_create(
+        listings,
+        update_conflicts=True,
+        unique_fields=["vehicle"],
+        update_fields=["data", "updated_at"],
+    )
+    return {listing.vehicle_id: listing.data for listing in listings}
+
+def listing_data(vehicles):
+    """
+    Serialized rows for vehicles loaded with select_related("listing"), in
+    order. Vehicles without a listing yet are serialized live and stored.
+    """
+    data = {}
+    missing = []
+    for v in vehicles:
+        listing = getattr(v, "listing", None)
+        if listing is None:
+            missing.append(v.pk)
+        else:
+            data[v.pk] = listing.data
+    if missing:
+        data.update(_store_listings(vehicle_queryset().filter(pk__in=missing)))
+    return [data[v.pk] for v in vehicles]
@@ -0,0 +1,125 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import Signal, receiver
+
+from .models import (
+    VehicleMaster,
+    Emirate,
+    DataVersion,
+)
+from .lookups import LOOKUP_MODELS
+from .serializers import refresh_listings
+from . import expiry, lookups, search
+
+# Sent with chassis_numbers=[...] once a write path has finished saving
+# vehicles and their permits. Bulk paths that bypass model signals must
+# send it too, so derived data (listings, ...) stays in sync and the fleet
+# version moves again once it is rebuilt.
+vehicles_changed = Signal()
+
+def bump_fleet_version(**kwargs):
+    DataVersion.bump_on_commit(DataVersion.FLEET)
+
+@receiver(post_save, sender=VehicleMaster)
+@receiver(post_delete, sender=VehicleMaster)
+def vehicle_saved(sender, instance, **kwargs):
+    # Covers saves that never send vehicles_changed; the bump that follows
+    # the listing rebuild is bump_fleet_version_after_rebuild
+    bump_fleet_version()
+
+@receiver(m2m_changed, sender=VehicleMaster.emirates_permit.through)
+def emirates_permit_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Permits are part of a vehicle's representation, so they version it
+    if reverse and action == "pre_clear":
+        # The links are gone by post_clear, so note whose they were now
+        instance._permit_holders = _vehicles_referencing(Emirate, instance)
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        instance.bump_version()
+        return
+    # Write paths send vehicles_changed for forward changes themselves;
+    # nothing does for emirate.vehiclemaster_set, so it is sent here
+    if action == "post_clear":
+        chassis_numbers = instance.__dict__.pop("_permit_holders", [])
+    else:
+        chassis_numbers = list(pk_set or ())
+    if chassis_numbers:
+        VehicleMaster.objects.filter(pk__in=chassis_numbers).update(version=F("version") + 1)
+        vehicles_changed.send(sender=VehicleMaster, chassis_numbers=chassis_numbers)
+
+def lookup_changed(**kwargs):
+    # Runs before lookup_saved so refreshed listings see the new names
+    lookups.invalidate()
+    DataVersion.bump_on_commit(DataVersion.LOOKUPS)
+
+for _model in LOOKUP_MODELS:
+    post_save.connect(lookup_changed, sender=_model, dispatch_uid=f"lookup_changed_save_{_model.__name__}")
+    post_delete.connect(lookup_changed, sender=_model, dispatch_uid=f"lookup_changed_delete_{_model.__name__}")
+    post_save.connect(bump_fleet_version, sender=_model, dispatch_uid=f"fleet_version_save_{_model.__name__}")
+    post_delete.connect(bump_fleet_version, sender=_model, dispatch_uid=f"fleet_version_delete_{_model.__name__}")
+
+# Derived data is rebuilt after the write commits, outside the write's
+# transaction and its row locks; on a rollback nothing needs rebuilding.
+
+@receiver(vehicles_changed)
+def refresh_vehicle_listings(sender, chassis_numbers, **kwargs):
+    chassis_numbers = list(chassis_numbers)
+    transaction.on_commit(lambda: refresh_listings(chassis_numbers))
+
+@receiver(vehicles_changed)
+def reindex_vehicles(sender, chassis_numbers, **kwargs):
+    chassis_numbers = list(chassis_numbers)
+    transaction.on_commit(lambda: search.index_vehicles(chassis_numbers))
+
+@receiver(vehicles_changed)
+def sync_expiry_events(sender, chassis_numbers, **kwargs):
+    chassis_numbers = list(chassis_numbers)
+    transaction.on_commit(lambda: expiry.sync_expiry_events(chassis_numbers))
+
+@receiver(vehicles_changed)
+def bump_fleet_version_after_rebuild(sender, **kwargs):
+    # Connected last, so its callback runs after the rebuilds above. An
+    # ETag handed out before them (with the old listings) then goes stale.
+    bump_fleet_version()
+
+@receiver(post_delete, sender=VehicleMaster)
+def unindex_vehicle(sender, instance, **kwargs):
+    chassis_number = instance.pk
+    transaction.on_commit(lambda: search.remove_vehicles([chassis_number]))
+
+def _vehicles_referencing(model, instance):
+    if model is Emirate:
+        through = VehicleMaster.emirates_permit.through
+        return list(through.objects.filter(emirate_id=instance.pk).values_list("vehiclemaster_id", flat=True))
+    field = next(
+        f.name for f in VehicleMaster._meta.concrete_fields
+        if f.is_relation and f.related_model is model
+    )
+    return list(VehicleMaster.objects.filter(**{f"{field}_id": instance.pk}).values_list("pk", flat=True))
+
+def lookup_saved(sender, instance, created, **kwargs):
+    # A renamed lookup changes the serialized form of every vehicle using it
+    if created:
+        return
+    chassis_numbers = _vehicles_referencing(sender, instance)
+    if chassis_numbers:
+        # Their representation changed, so their ETags must too
+        VehicleMaster.objects.filter(pk__in=chassis_numbers).update(version=F("version") + 1)
+        vehicles_changed.send(sender=VehicleMaster, chassis_numbers=chassis_numbers)
+
+for _model in LOOKUP_MODELS:
+    post_save.connect(lookup_saved, sender=_model, dispatch_uid=f"lookup_saved_{_model.__name__}")
+
+@receiver(pre_delete, sender=Emirate)
+def emirate_deleting(sender, instance, **kwargs):
+    # The cascade drops the permit links without an m2m_changed signal
+    instance._permit_holders = _vehicles_referencing(Emirate, instance)
+
+@receiver(post_delete, sender=Emirate)
+def emirate_deleted(sender, instance, **kwargs):
+    chassis_numbers = instance.__dict__.pop("_permit_holders", [])
+    if chassis_numbers:
+        VehicleMaster.objects.filter(pk__in=chassis_numbers).update(version=F("version") + 1)
+        vehicles_changed.send(sender=VehicleMaster, chassis_numbers=chassis_numbers)
@@ -1,3 +1,438 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase, override_settings
+
+from . import archive, expiry, history, lookups
+from .models import (
+    VehicleMaster,
+    VehicleCapacity,
+    VehicleType,
+    ToteCapacity,
+    Status,
+    VehicleConcept,
+    Make,
+    GPS,
+    BrandingStatus,
+    TailLiftBrand,
+    ChangeSet,
+    DataVersion,
+    ExpiryRun,
+    Notification,
+    VehicleListing,
+    VehicleSnapshot,
+    VersionConflict,
+)
+from .serializers import refresh_listings
+from .signals import vehicles_changed
+
+def _first(model):
+    return model.objects.order_by("pk").first()
+
+def make_vehicle(i, emirates=(), **fields):
+    """Create vehicle CH{i:05d} with the first row of every lookup table."""
+    today = date.today()
+    values = dict(
+        chassis_number=f"CH{i:05d}",
+        plate_number=f"DXB-{i:05d}",
+        vehicle_capacity=_first(VehicleCapacity),
+        vehicle_type=_first(VehicleType),
+        tote_capacity=_first(ToteCapacity),
+        status=_first(Status),
+        vehicle_concept=_first(VehicleConcept),
+        make=_first(Make),
+        truck_reg_date=today,
+        insurance_registration_date=today,
+        mulkia_registration_date=today,
+        permit_registration_date=today,
+        tl_no=i,
+        tc_no=1000 + i,
+        tc_owner=f"Owner {i}",
+        salik_account_no=f"SA{i}",
+        salik_tag_no=f"ST{i}",
+        darb_ac_no=f"DA{i}",
+        gps=_first(GPS),
+        branding_status=_first(BrandingStatus),
+        lift_gate=False,
+        tail_lift_brand=_first(TailLiftBrand),
+        remarks="",
+    )
+    values.update(fields)
+    vehicle = VehicleMaster.objects.create(**values)
+    if emirates:
+        vehicle.emirates_permit.set(emirates)
+    vehicles_changed.send(sender=VehicleMaster, chassis_numbers=[vehicle.pk])
+    return vehicle
+
+class OfficeUserTestCase(TestCase):
+    def setUp(self):
+        # Process-level caches outlive the rolled back test transactions
+        cache.clear()
+        lookups.invalidate()
+        self.user = User.objects.create_user("alice", password="pw")
+        self.user.groups.add(Group.objects.get_or_create(name="office_user")[0])
+        self.client.login(username="alice", password="pw")
+
+    def put_json(self, url, body, **headers):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.put(url, json.dumps(body), content_type="application/json", **headers)
+
+    def post_json(self, url, body, **headers):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(url, json.dumps(body), content_type="application/json", **headers)
+
+# -------------------------------
+# Vehicle list
+# -------------------------------
+
+class VehicleListPaginationTests(OfficeUserTestCase):
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(25):
+                # Every third vehicle has no truck expiry date
+                expires = None if i % 3 == 0 else date(2030, 1, 1) + timedelta(days=i % 4)
+                make_vehicle(i, truck_registration_expiry_date=expires)
+
+    def _all_pages(self, sort, limit=4):
+        seen, cursor = [], None
+        while True:
+            params = {"limit": limit, "sort": sort}
+            if cursor:
+                params["cursor"] = cursor
+            response = self.client.get("/office/api/vehicle-master/", params)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            seen += [row["chassis_number"] for row in data["results"]]
+            cursor = data["next_cursor"]
+            if not cursor:
+                return seen
+
+    def test_pages_cross_null_boundary(self):
+        rows = list(VehicleMaster.objects.values_list("pk", "truck_registration_expiry_date"))
+        for descending in (False, True):
+            with self.subTest(descending=descending):
+                dated = sorted((row for row in rows if row[1] is not None), key=lambda row: (row[1], row[0]), reverse=descending)
+                undated = sorted((row[0] for row in rows if row[1] is None), reverse=descending)
+                sort = ("-" if descending else "") + "truck_registration_expiry_date"
+                self.assertEqual(self._all_pages(sort), [row[0] for row in dated] + undated)
+
+    def test_fleet_etag_moves_again_after_the_listings(self):
+        url = "/office/api/vehicle-master/"
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.put(f"{url}CH00001/", json.dumps({"remarks": "new"}), content_type="application/json")
+        stale_etags = []
+        for callback in callbacks:
+            callback()
+            # A GET between two callbacks may still see the old listing
+            response = self.client.get(url, {"limit": 5})
+            if response.json()["results"][1]["remarks"] != "new":
+                stale_etags.append(response["ETag"])
+        for etag in stale_etags:
+            response = self.client.get(url, {"limit": 5}, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["results"][1]["remarks"], "new")
+
+    def test_bad_sort_or_cursor_is_rejected(self):
+        self.assertEqual(self.client.get("/office/api/vehicle-master/", {"sort": "bogus"}).status_code, 400)
+        self.assertEqual(self.client.get("/office/api/vehicle-master/", {"cursor": "zz"}).status_code, 400)
+
+# -------------------------------
+# Lookup registry
+# -------------------------------
+
+class LookupRegistryTests(OfficeUserTestCase):
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            make_vehicle(1)
+        self.make = _first(Make)
+        self.other_make = Make.objects.exclude(pk=self.make.pk).order_by("pk").first()
+
+    def rename_elsewhere(self, make, name):
+        """Rename as another process would: this process's registry is not invalidated."""
+        Make.objects.filter(pk=make.pk).update(name=name)
+        DataVersion.bump(DataVersion.LOOKUPS)
+
+    def test_derived_data_is_written_with_current_names(self):
+        stale = lookups.get_registry()
+        self.rename_elsewhere(self.make, "Renamed elsewhere")
+        self.rename_elsewhere(self.other_make, "Other renamed")
+        # Reads may still use the old registry inside the check interval
+        self.assertIs(lookups.get_registry(), stale)
+
+        refresh_listings(["CH00001"])
+        self.assertEqual(VehicleListing.objects.get(pk="CH00001").data["make"]["name"], "Renamed elsewhere")
+        fresh = lookups.get_registry()
+        self.assertIsNot(fresh, stale)
+        self.assertNotEqual(fresh.version, stale.version)
+
+        lookups._checked_at = time.monotonic()
+        lookups._registry = stale
+        self.put_json("/office/api/vehicle-master/CH00001/", {"make_id": self.other_make.pk})
+        changes = ChangeSet.objects.get(chassis_number="CH00001").changes
+        self.assertEqual(changes["make"], ["Renamed elsewhere", "Other renamed"])
+
+# -------------------------------
+# Bulk upsert
+# -------------------------------
+
+class BulkUpsertTests(OfficeUserTestCase):
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(3):
+                make_vehicle(i, remarks=f"remark {i}")
+
+    def test_duplicate_and_invalid_items_leave_rows_alone(self):
+        response = self.post_json("/office/api/vehicle-master/bulk/", [
+            {"chassis_number": "CH00000", "remarks": "first"},
+            {"chassis_number": "CH00000", "remarks": "second"},
+            {"chassis_number": "CH00001", "remarks": "lost", "truck_reg_date": "bad"},
+            {"chassis_number": "CH00002", "remarks": "lost", "truck_reg_date": None},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r["status"] for r in response.json()["results"]], ["updated", "error", "error", "error"])
+
+        # The duplicate neither overwrote the first item nor reached the change log
+        self.assertEqual(VehicleMaster.objects.get(pk="CH00000").remarks, "first")
+        self.assertEqual(ChangeSet.objects.get(chassis_number="CH00000").changes["remarks"], ["remark 0", "first"])
+        # Failed validation must not leak half-applied values into later saves
+        self.assertEqual(VehicleMaster.objects.get(pk="CH00001").remarks, "remark 1")
+        self.assertEqual(VehicleMaster.objects.get(pk="CH00002").remarks, "remark 2")
+        self.assertIsNotNone(VehicleMaster.objects.get(pk="CH00002").truck_reg_date)
+        self.assertFalse(ChangeSet.objects.filter(chassis_number__in=["CH00001", "CH00002"]).exists())
+        self.assertEqual(VehicleListing.objects.get(pk="CH00000").data["remarks"], "first")
+
+# -------------------------------
+# Optimistic versioning
+# -------------------------------
+
+class VehicleVersionTests(OfficeUserTestCase):
+    url = "/office/api/vehicle-master/CH00001/"
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            make_vehicle(1)
+
+    def test_stale_if_match_is_rejected(self):
+        etag = self.client.get(self.url)["ETag"]
+        response = self.put_json(self.url, {"remarks": "a"}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+        response = self.put_json(self.url, {"remarks": "b"}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response.json()["version"], VehicleMaster.objects.get(pk="CH00001").version)
+        self.assertEqual(VehicleMaster.objects.get(pk="CH00001").remarks, "a")
+
+    def test_detail_ignores_listing_of_an_older_version(self):
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.put(self.url, json.dumps({"remarks": "new"}), content_type="application/json")
+        # The listing still holds the previous version until its refresh runs
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()["remarks"], "new")
+        self.assertEqual(response.json()["version"], VehicleMaster.objects.get(pk="CH00001").version)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.client.get(self.url).json()["remarks"], "new")
+
+    def test_concurrent_save_conflicts(self):
+        first = VehicleMaster.objects.get(pk="CH00001")
+        second = VehicleMaster.objects.get(pk="CH00001")
+        first.remarks = "first"
+        first.save()
+        second.tc_owner = "second"
+        with self.assertRaises(VersionConflict), transaction.atomic():
+            second.save()
+        self.assertEqual(VehicleMaster.objects.get(pk="CH00001").tc_owner, "Owner 1")
+
+# -------------------------------
+# Point-in-time reads
+# -------------------------------
+
+class VehicleAsOfTests(OfficeUserTestCase):
+    url = "/office/api/vehicle-master/CH00001/"
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            make_vehicle(1, remarks="r0")
+        for i in range(1, 7):
+            self.put_json(self.url, {"remarks": f"r{i}"})
+            if i == 3:
+                history.take_snapshots(["CH00001"])
+        # One change a day from a fixed start, so `at` can fall between them
+        self.start = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+        for day, changeset in enumerate(ChangeSet.objects.order_by("id"), start=1):
+            ChangeSet.objects.filter(pk=changeset.pk).update(timestamp=self.start + timedelta(days=day))
+        snapshot = VehicleSnapshot.objects.get()
+        snapshot.timestamp = ChangeSet.objects.get(pk=snapshot.changeset_id).timestamp
+        snapshot.save()
+
+    def as_of(self, days):
+        at = self.start + timedelta(days=days, hours=12)
+        response = self.client.get(f"{self.url}as-of/", {"at": at.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_replays_back_from_the_next_snapshot(self):
+        snapshot = VehicleSnapshot.objects.get()
+        for days in range(7):
+            with self.subTest(days=days):
+                data = self.as_of(days)
+                self.assertEqual(data["vehicle"]["remarks"], f"r{days}")
+                if days < 3:
+                    # Undoing from the snapshot at r3, not from the current row
+                    self.assertEqual(data["replayed_from"], snapshot.timestamp.isoformat())
+                    self.assertEqual(data["changes_undone"], 3 - days)
+                else:
+                    self.assertEqual(data["replayed_from"], "current")
+                    self.assertEqual(data["changes_undone"], 6 - days)
+
+    def test_fleet_as_of_matches_vehicle_as_of(self):
+        at = self.start + timedelta(days=1, hours=12)
+        response = self.client.get("/office/api/vehicle-master/as-of/", {"at": at.isoformat()})
+        rows = list(csv.DictReader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual([row["remarks"] for row in rows], ["r1"])
+
+# -------------------------------
+# Change log archive
+# -------------------------------
+
+class ChangeLogArchiveTests(OfficeUserTestCase):
+    def setUp(self):
+        super().setUp()
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        settings_override = override_settings(CHANGE_LOG_ARCHIVE_ROOT=archive_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(3):
+                make_vehicle(i)
+        for i in range(12):
+            self.put_json(f"/office/api/vehicle-master/CH{i % 3:05d}/", {"remarks": f"r{i}", "tc_owner": f"o{i}"})
+        # Spread the changes over eight months
+        start = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+        for n, changeset in enumerate(ChangeSet.objects.order_by("id")):
+            ChangeSet.objects.filter(pk=changeset.pk).update(timestamp=start + timedelta(days=20 * n))
+
+    def _all_pages(self, params, limit=5):
+        entries, cursor = [], None
+        while True:
+            page = dict(params, limit=limit)
+            if cursor:
+                page["cursor"] = cursor
+            response = self.client.get("/office/api/change-log/", page)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            entries += data["results"]
+            cursor = data["next_cursor"]
+            if not cursor:
+                return entries
+
+    def test_cursor_pages_cross_into_the_archive(self):
+        filters = [{}, {"chassis_number": "CH00001"}, {"plate": "dxb-0000"}, {"field": "remarks"}]
+        before = [self._all_pages(params) for params in filters]
+        self.assertEqual(len(before[0]), 24)
+        self.assertEqual(before[2], before[0])
+
+        moved = archive.archive_change_log(older_than=datetime(2024, 5, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(moved, 7)
+        self.assertEqual(ChangeSet.objects.count(), 5)
+        self.assertEqual(sum(manifest["rows"] for manifest in archive.manifests()), 7)
+
+        for params, expected in zip(filters, before):
+            with self.subTest(params=params):
+                self.assertEqual(self._all_pages(params), expected)
+        # A rerun finds nothing left to move
+        self.assertEqual(archive.archive_change_log(older_than=datetime(2024, 5, 1, tzinfo=dt_timezone.utc)), 0)
+
+    def test_as_of_reads_the_archive_only_up_to_the_snapshot(self):
+        url = "/office/api/vehicle-master/CH00001/as-of/"
+        # CH00001 changed on Jan 21, Mar 21, May 20 and Jul 19; checkpoint it at Mar 21
+        changeset = ChangeSet.objects.filter(chassis_number="CH00001").order_by("id")[1]
+        state = self.client.get(url, {"at": changeset.timestamp.isoformat()}).json()["vehicle"]
+        VehicleSnapshot.objects.create(
+            chassis_number="CH00001", timestamp=changeset.timestamp, changeset_id=changeset.id, data=state,
+        )
+        moments = [datetime(2024, month, 5, tzinfo=dt_timezone.utc) for month in range(1, 9)]
+        before = [self.client.get(url, {"at": at.isoformat()}).json()["vehicle"] for at in moments]
+        fleet_before = [b"".join(self.client.get("/office/api/vehicle-master/as-of/", {"at": at.isoformat()}).streaming_content) for at in moments]
+
+        archive.archive_change_log(older_than=datetime(2024, 5, 1, tzinfo=dt_timezone.utc))
+        opened = []
+        iter_month = archive._iter_month
+        def tracking(month):
+            opened.append(month)
+            return iter_month(month)
+        with mock.patch.object(archive, "_iter_month", tracking):
+            response = self.client.get(url, {"at": datetime(2024, 1, 22, tzinfo=dt_timezone.utc).isoformat()})
+        self.assertEqual(response.json()["vehicle"]["remarks"], "r1")
+        # January ends before `at`, February has no CH00001 rows, April is past the snapshot
+        self.assertEqual(opened, ["2024-03"])
+
+        self.assertEqual([self.client.get(url, {"at": at.isoformat()}).json()["vehicle"] for at in moments], before)
+        fleet_after = [b"".join(self.client.get("/office/api/vehicle-master/as-of/", {"at": at.isoformat()}).streaming_content) for at in moments]
+        self.assertEqual(fleet_after, fleet_before)
+
+# -------------------------------
+# Expiry notifications
+# -------------------------------
+
+class IncrementalExpiryTests(OfficeUserTestCase):
+    def setUp(self):
+        super().setUp()
+        self.today = date.today()
+        with self.captureOnCommitCallbacks(execute=True):
+            for i, days in enumerate((10, 40, 70)):
+                make_vehicle(i, insurance_registration_expiry_date=self.today + timedelta(days=days))
+
+    def notified(self):
+        return set(Notification.objects.filter(user=self.user).values_list("vehicle_id", flat=True))
+
+    def test_incremental_runs_match_full_runs(self):
+        self.assertEqual(expiry.check_expirations(today=self.today)["insurance"], 1)
+        self.assertEqual(self.notified(), {"CH00000"})
+
+        # CH00001's 30-day window opened since the last run
+        later = self.today + timedelta(days=15)
+        self.assertEqual(expiry.check_expirations(today=later, incremental=True)["insurance"], 1)
+        self.assertEqual(self.notified(), {"CH00000", "CH00001"})
+        self.assertEqual(sum(expiry.check_expirations(today=later).values()), 0)
+
+        # An edit into an already open window is picked up by its change time
+        self.put_json(
+            "/office/api/vehicle-master/CH00002/",
+            {"insurance_registration_expiry_date": (self.today + timedelta(days=20)).isoformat()},
+        )
+        self.assertEqual(expiry.check_expirations(today=later, incremental=True)["insurance"], 1)
+        self.assertEqual(self.notified(), {"CH00000", "CH00001", "CH00002"})
+        self.assertEqual(sum(expiry.check_expirations(today=later, incremental=True).values()), 0)
+
+        runs = list(ExpiryRun.objects.order_by("started_at").values_list("incremental", flat=True))
+        self.assertEqual(runs, [False, True, False, True, True])
+
+    def test_notifications_are_inserted_in_batches(self):
+        group = Group.objects.get(name="office_user")
+        for i in range(4):
+            User.objects.create_user(f"user{i}").groups.add(group)
+        bulk_create = Notification.objects.bulk_create
+        with mock.patch.object(expiry, "NOTIFICATION_BATCH_SIZE", 2), \
+                mock.patch.object(Notification.objects, "bulk_create", wraps=bulk_create) as inserts:
+            created = expiry.check_expirations(today=self.today)
+        self.assertEqual(created["insurance"], 5)
+        self.assertEqual([len(c.args[0]) for c in inserts.call_args_list], [2, 2, 1])
+        self.assertEqual(Notification.objects.filter(vehicle_id="CH00000").count(), 5)
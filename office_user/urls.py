@@ -7,11 +7,22 @@ from .views import (
     vehicle_update,
     vehicle_create,
     change_log,
+    change_log_api,
     vehicle_master_api,
     vehicle_master_detail_api,
+    vehicle_stats_api,
+    vehicle_search_api,
+    vehicle_bulk_api,
+    vehicle_import_api,
+    vehicle_as_of_api,
+    vehicle_history_api,
+    fleet_as_of_api,
     dropdowns_api,
     vehicle_edit_partial,
     download_csv,
+    export_jobs_api,
+    export_job_api,
+    export_job_download,
     notifications_api,
     notification_action_api,
     user_notification_settings_api,
@@ -27,10 +38,21 @@ urlpatterns = [
     path('vehicle-create/', vehicle_create, name='vehicle_create'),
     path('vehicle-edit-partial/', vehicle_edit_partial, name='vehicle_edit_partial'),
     path('change-log/', change_log, name='change_log'),
+    path('api/change-log/', change_log_api, name='change_log_api'),
     path('api/vehicle-master/', vehicle_master_api, name='vehicle_master_api'),
+    path('api/vehicle-master/stats/', vehicle_stats_api, name='vehicle_stats_api'),
+    path('api/vehicle-master/search/', vehicle_search_api, name='vehicle_search_api'),
+    path('api/vehicle-master/bulk/', vehicle_bulk_api, name='vehicle_bulk_api'),
+    path('api/vehicle-master/import/', vehicle_import_api, name='vehicle_import_api'),
+    path('api/vehicle-master/as-of/', fleet_as_of_api, name='fleet_as_of_api'),
     path('api/vehicle-master/<str:chassis_number>/', vehicle_master_detail_api, name='vehicle_master_detail_api'),
+    path('api/vehicle-master/<str:chassis_number>/as-of/', vehicle_as_of_api, name='vehicle_as_of_api'),
+    path('api/vehicle-master/<str:chassis_number>/history/', vehicle_history_api, name='vehicle_history_api'),
     path('api/dropdowns/', dropdowns_api, name='dropdowns_api'),
     path('download-csv/', download_csv, name='download_csv'),
+    path('api/exports/', export_jobs_api, name='export_jobs_api'),
+    path('api/exports/<int:job_id>/', export_job_api, name='export_job_api'),
+    path('api/exports/<int:job_id>/download/', export_job_download, name='export_job_download'),
     path('api/notifications/', notifications_api, name='notifications_api'),
     path('api/notifications/<int:notification_id>/<str:action>/', notification_action_api, name='notification_action_api'),
     path('api/user-notification-settings/', user_notification_settings_api, name='user_notification_settings_api'),
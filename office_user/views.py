@@ -2,13 +2,26 @@ from django.shortcuts import render, redirect
 from django.views import View
 from django.contrib.auth import authenticate, login, logout
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponse
+from django.http import FileResponse, JsonResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
-from django.db import transaction
-from django.utils.dateparse import parse_date
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q
+from django.db.models.functions import Upper
+from django.urls import reverse
+from django.utils.cache import parse_etags
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from datetime import date, datetime
+from functools import wraps
+import base64
+import hashlib
+import itertools
 import json
-import csv
+import re
+import tempfile
+import io
 
 from .models import (
     VehicleMaster,
@@ -22,10 +35,35 @@ from .models import (
     GPS,
     BrandingStatus,
     TailLiftBrand,
-    ChangeLog,
+    ChangeSet,
     Notification,
     UserNotificationSettings,
+    DataVersion,
+    ExpiryEvent,
+    ExportJob,
+    VehicleListing,
+    VersionConflict,
 )
+from .serializers import (
+    VEHICLE_FIELDS,
+    listing_data,
+    load_vehicle,
+    serialize_vehicle,
+    vehicle_queryset,
+)
+from .signals import vehicles_changed
+from .imports import CSVFormatError, import_vehicles
+from .writes import (
+    LOGGED_FIELDS,
+    apply_payload,
+    bulk_upsert_vehicles,
+    log_changes,
+    parse_date_or_none,
+    parse_int_or_none,
+    save_changes,
+    set_permits,
+)
+from . import archive, export_jobs, exports, history, lookups, search
 from django.utils import timezone
 from datetime import timedelta
 
@@ -57,12 +95,8 @@ def vehicle_master(request):
 
 @login_required(login_url='login')
 def vehicle_update(request, chassis_number):
-    change_logs = ChangeLog.objects.filter(chassis_number=chassis_number).order_by('-date', '-time')
-    context = {
-        'chassis_number': chassis_number,
-        'change_logs': change_logs,
-    }
-    return render(request, 'vehicle_update.html', context)
+    # The history panel pages itself in from vehicle_history_api
+    return render(request, 'vehicle_update.html', {'chassis_number': chassis_number})
 
 @login_required(login_url='login')
 def vehicle_create(request):
@@ -74,302 +108,515 @@ def vehicle_edit_partial(request):
     return render(request, 'vehicle_edit_partial.html')
 
 def change_log(request):
-    logs = ChangeLog.objects.order_by('-date', '-time')
-    return render(request, 'change_log.html', {'change_logs': logs})
+    # Only the first page is rendered; the page pulls the rest from change_log_api
+    try:
+        entries, next_cursor = _change_log_page(request.GET)
+    except ValueError:
+        entries, next_cursor = _change_log_page({})
+    context = {
+        'change_logs': entries,
+        'next_cursor': next_cursor,
+        'field_names': LOGGED_FIELDS,
+    }
+    return render(request, 'change_log.html', context)
 
 # -------------------------------
 # Vehicle Master JSON API (GET, POST, PUT)
 # -------------------------------
 
-def _file_url_or_none(field_file):
+def _parse_fields(params):
+    """Return the requested ?fields= list, or None for the full representation."""
+    raw = params.get("fields")
+    if not raw:
+        return None
+    fields = [f.strip() for f in raw.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in VEHICLE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def _request_username(request):
+    return request.user.username if getattr(request, "user", None) and request.user.is_authenticated else None
+
+# -------------------------------
+# Vehicle list filtering, sorting and keyset pagination
+# -------------------------------
+
+# Query parameter -> FK column for the lookup filters (?status=1,2&make=3)
+VEHICLE_FK_FILTERS = {
+    "vehicle_capacity": "vehicle_capacity_id",
+    "vehicle_type": "vehicle_type_id",
+    "tote_capacity": "tote_capacity_id",
+    "status": "status_id",
+    "vehicle_concept": "vehicle_concept_id",
+    "make": "make_id",
+    "gps": "gps_id",
+    "branding_status": "branding_status_id",
+    "tail_lift_brand": "tail_lift_brand_id",
+}
+
+# Document type -> expiry column, same keys as the notification types
+VEHICLE_EXPIRY_FIELDS = {
+    "truck": "truck_registration_expiry_date",
+    "insurance": "insurance_registration_expiry_date",
+    "mulkia": "mulkia_registration_expiry_date",
+    "permit": "permit_registration_expiry_date",
+}
+
+VEHICLE_SORT_FIELDS = [
+    "chassis_number",
+    "plate_number",
+    "truck_reg_date",
+    "truck_registration_expiry_date",
+    "insurance_registration_date",
+    "insurance_registration_expiry_date",
+    "mulkia_registration_date",
+    "mulkia_registration_expiry_date",
+    "permit_registration_date",
+    "permit_registration_expiry_date",
+    "tl_no",
+    "tc_no",
+]
+
+VEHICLE_SEARCH_FIELDS = [
+    "chassis_number",
+    "plate_number",
+    "make__name",
+    "tc_owner",
+    "salik_account_no",
+    "salik_tag_no",
+    "darb_ac_no",
+]
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+def _parse_id_list(value):
+    try:
+        return [int(x) for x in value.split(",") if x.strip()]
+    except ValueError:
+        raise ValueError(f"Invalid id list: {value}")
+
+def _filter_vehicles(qs, params):
+    """Apply the list API query parameters to a VehicleMaster queryset."""
+    for param, column in VEHICLE_FK_FILTERS.items():
+        if params.get(param):
+            qs = qs.filter(**{f"{column}__in": _parse_id_list(params[param])})
+
+    if params.get("emirate"):
+        # EXISTS on the through table instead of a join, so rows are not duplicated
+        through = VehicleMaster.emirates_permit.through
+        qs = qs.filter(Exists(through.objects.filter(
+            vehiclemaster_id=OuterRef("pk"),
+            emirate_id__in=_parse_id_list(params["emirate"]),
+        )))
+
+    if params.get("lift_gate"):
+        qs = qs.filter(lift_gate=params["lift_gate"].lower() in ("true", "1", "on", "yes"))
+
+    # Expiry windows: ?expiry=insurance&expiring_within=30, or explicit
+    # ?expires_after=/?expires_before= dates. Without ?expiry any document matches.
+    expiry = params.get("expiry")
+    if expiry and expiry not in VEHICLE_EXPIRY_FIELDS:
+        raise ValueError(f"Invalid expiry: {expiry}")
+
+    window = {}
+    if params.get("expiring_within"):
+        days = parse_int_or_none(params["expiring_within"])
+        if days is None or days < 0:
+            raise ValueError("expiring_within must be a non-negative number of days")
+        today = timezone.now().date()
+        window["gte"] = today
+        window["lte"] = today + timedelta(days=days)
+    for param, lookup in (("expires_after", "gte"), ("expires_before", "lte")):
+        if params.get(param):
+            parsed = parse_date_or_none(params[param])
+            if parsed is None:
+                raise ValueError(f"Invalid date for {param}: {params[param]}")
+            window[lookup] = parsed
+    if window:
+        # One date range seek on the expiry events instead of OR-ing four columns
+        events = ExpiryEvent.objects.filter(vehicle_id=OuterRef("pk"), **{f"expires_on__{lookup}": value for lookup, value in window.items()})
+        if expiry:
+            events = events.filter(notification_type=expiry)
+        qs = qs.filter(Exists(events))
+
+    term = (params.get("q") or "").strip()
+    if term:
+        search_q = Q()
+        for field in VEHICLE_SEARCH_FIELDS:
+            search_q |= Q(**{f"{field}__icontains": term})
+        qs = qs.filter(search_q)
+
+    return qs
+
+def _parse_sort(value):
+    """Return (field, descending) for a ?sort= value such as "-plate_number"."""
+    value = value or "chassis_number"
+    descending = value.startswith("-")
+    field = value.lstrip("-")
+    if field not in VEHICLE_SORT_FIELDS:
+        raise ValueError(f"Invalid sort field: {field}")
+    return field, descending
+
+def _order_vehicles(qs, field, descending):
+    # NULLs always sort last and chassis_number breaks ties, so the order is total
+    if field == "chassis_number":
+        return qs.order_by("-pk" if descending else "pk")
+    if descending:
+        return qs.order_by(F(field).desc(nulls_last=True), "-pk")
+    return qs.order_by(F(field).asc(nulls_last=True), "pk")
+
+def _encode_cursor(sort_value, value, pk):
+    if isinstance(value, date):
+        value = value.isoformat()
+    raw = json.dumps({"s": sort_value, "v": value, "k": pk}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor, sort_value, field):
     try:
-        return field_file.url if field_file else None
+        padded = cursor + "=" * (-len(cursor) % 4)
+        decoded = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if decoded["s"] != sort_value:
+            raise ValueError
+        value = VehicleMaster._meta.get_field(field).to_python(decoded["v"])
+        return value, decoded["k"]
     except Exception:
-        return None
+        raise ValueError("Invalid cursor")
+
+def _seek_page(qs, field, descending, limit, after=None):
+    """
+    Up to `limit` rows in list order, strictly after the (value, pk) cursor
+    position `after` (from the start when None). Rows with a sort value and
+    the trailing NULL block are read by separate queries, each a range scan
+    of the (field, chassis_number) index in plain index order.
+    """
+    pk_order = "-pk" if descending else "pk"
+    op = "lt" if descending else "gt"
+    if field == "chassis_number":
+        page = qs.order_by(pk_order)
+        if after is not None:
+            page = page.filter(**{f"pk__{op}": after[1]})
+        return list(page[:limit])
+
+    rows = []
+    if after is None or after[0] is not None:
+        page = qs.filter(**{f"{field}__isnull": False}).order_by(f"-{field}" if descending else field, pk_order)
+        if after is not None:
+            value, pk = after
+            # The leading bound keeps it a range scan; the OR only trims ties
+            page = page.filter(
+                Q(**{f"{field}__{op}e": value}),
+                Q(**{f"{field}__{op}": value}) | Q(**{field: value, f"pk__{op}": pk}),
+            )
+        rows = list(page[:limit])
+    if len(rows) < limit and VehicleMaster._meta.get_field(field).null:
+        tail = qs.filter(**{f"{field}__isnull": True}).order_by(pk_order)
+        if after is not None and after[0] is None:
+            tail = tail.filter(**{f"pk__{op}": after[1]})
+        rows += list(tail[:limit - len(rows)])
+    return rows
+
+def _paginate_vehicles(qs, params):
+    """
+    Keyset pagination for the list API. Returns (rows, next_cursor); rows
+    may be model instances or values() dicts that include the sort column.
+
+    The cursor is an opaque token holding the sort key and chassis_number of
+    the last row, so every page is an index seek regardless of its depth.
+    """
+    sort_value = params.get("sort") or "chassis_number"
+    field, descending = _parse_sort(sort_value)
+
+    limit = parse_int_or_none(params.get("limit")) or DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    after = _decode_cursor(params["cursor"], sort_value, field) if params.get("cursor") else None
+    rows = _seek_page(qs, field, descending, limit + 1, after)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if isinstance(last, dict):
+            next_cursor = _encode_cursor(sort_value, last[field], last["chassis_number"])
+        else:
+            next_cursor = _encode_cursor(sort_value, getattr(last, field), last.pk)
+    return rows, next_cursor
 
-def serialize_vehicle(v: VehicleMaster):
-    return {
-        "chassis_number": v.chassis_number,
-        "plate_number": v.plate_number,
-        "vehicle_capacity": {
-            "id": v.vehicle_capacity_id,
-            "name": v.vehicle_capacity.name if v.vehicle_capacity_id else None,
-        },
-        "vehicle_type": {
-            "id": v.vehicle_type_id,
-            "name": v.vehicle_type.name if v.vehicle_type_id else None,
-        },
-        "tote_capacity": {
-            "id": v.tote_capacity_id,
-            "name": v.tote_capacity.name if v.tote_capacity_id else None,
-        },
-        "status": {
-            "id": v.status_id,
-            "name": v.status.name if v.status_id else None,
-        },
-        "vehicle_concept": {
-            "id": v.vehicle_concept_id,
-            "name": v.vehicle_concept.name if v.vehicle_concept_id else None,
-        },
-        "make": {
-            "id": v.make_id,
-            "name": v.make.name if v.make_id else None,
-        },
-        "truck_reg_date": v.truck_reg_date.isoformat() if v.truck_reg_date else None,
-        "truck_registration_expiry_date": v.truck_registration_expiry_date.isoformat() if v.truck_registration_expiry_date else None,
-        "insurance_document_url": _file_url_or_none(v.insurance_document),
-        "insurance_registration_date": v.insurance_registration_date.isoformat() if v.insurance_registration_date else None,
-        "insurance_registration_expiry_date": v.insurance_registration_expiry_date.isoformat() if v.insurance_registration_expiry_date else None,
-        "mulkia_registration_date": v.mulkia_registration_date.isoformat() if v.mulkia_registration_date else None,
-        "mulkia_registration_expiry_date": v.mulkia_registration_expiry_date.isoformat() if v.mulkia_registration_expiry_date else None,
-        "mulkia_document_url": _file_url_or_none(v.mulkia_document),
-        "emirates_permit": [{"id": e.id, "name": e.name} for e in v.emirates_permit.all()],
-        "permit_registration_date": v.permit_registration_date.isoformat() if v.permit_registration_date else None,
-        "permit_registration_expiry_date": v.permit_registration_expiry_date.isoformat() if v.permit_registration_expiry_date else None,
-        "permit_document_url": _file_url_or_none(v.permit_document),
-        "tl_no": v.tl_no,
-        "tc_no": v.tc_no,
-        "tc_owner": v.tc_owner,
-        "salik_account_no": v.salik_account_no,
-        "salik_tag_no": v.salik_tag_no,
-        "darb_ac_no": v.darb_ac_no,
-        "gps": {
-            "id": v.gps_id,
-            "name": v.gps.name if v.gps_id else None,
-        },
-        "branding_status": {
-            "id": v.branding_status_id,
-            "name": v.branding_status.name if v.branding_status_id else None,
-        },
-        "lift_gate": v.lift_gate,
-        "tail_lift_brand": {
-            "id": v.tail_lift_brand_id,
-            "name": v.tail_lift_brand.name if v.tail_lift_brand_id else None,
-        },
-        "remarks": v.remarks,
-        "truck_photos_url": _file_url_or_none(v.truck_photos),
-    }
+def _is_paginated(params):
+    return "limit" in params or "cursor" in params
 
-def _snapshot_vehicle(v: VehicleMaster):
-    return {
-        "plate_number": v.plate_number,
-        "vehicle_capacity": v.vehicle_capacity.name if v.vehicle_capacity_id else "",
-        "vehicle_type": v.vehicle_type.name if v.vehicle_type_id else "",
-        "tote_capacity": v.tote_capacity.name if v.tote_capacity_id else "",
-        "status": v.status.name if v.status_id else "",
-        "vehicle_concept": v.vehicle_concept.name if v.vehicle_concept_id else "",
-        "make": v.make.name if v.make_id else "",
-        "truck_reg_date": v.truck_reg_date.isoformat() if v.truck_reg_date else "",
-        "truck_registration_expiry_date": v.truck_registration_expiry_date.isoformat() if v.truck_registration_expiry_date else "",
-        "insurance_registration_date": v.insurance_registration_date.isoformat() if v.insurance_registration_date else "",
-        "insurance_registration_expiry_date": v.insurance_registration_expiry_date.isoformat() if v.insurance_registration_expiry_date else "",
-        "mulkia_registration_date": v.mulkia_registration_date.isoformat() if v.mulkia_registration_date else "",
-        "mulkia_registration_expiry_date": v.mulkia_registration_expiry_date.isoformat() if v.mulkia_registration_expiry_date else "",
-        "permit_registration_date": v.permit_registration_date.isoformat() if v.permit_registration_date else "",
-        "permit_registration_expiry_date": v.permit_registration_expiry_date.isoformat() if v.permit_registration_expiry_date else "",
-        "tl_no": str(v.tl_no) if v.tl_no is not None else "",
-        "tc_no": str(v.tc_no) if v.tc_no is not None else "",
-        "tc_owner": v.tc_owner or "",
-        "salik_account_no": v.salik_account_no or "",
-        "salik_tag_no": v.salik_tag_no or "",
-        "darb_ac_no": v.darb_ac_no or "",
-        "gps": v.gps.name if v.gps_id else "",
-        "branding_status": v.branding_status.name if v.branding_status_id else "",
-        "lift_gate": "true" if v.lift_gate else "false",
-        "tail_lift_brand": v.tail_lift_brand.name if v.tail_lift_brand_id else "",
-        "remarks": v.remarks or "",
-        "insurance_document": _file_url_or_none(v.insurance_document) or "",
-        "mulkia_document": _file_url_or_none(v.mulkia_document) or "",
-        "permit_document": _file_url_or_none(v.permit_document) or "",
-        "truck_photos": _file_url_or_none(v.truck_photos) or "",
+def _list_queryset(fields, sort_field):
+    # The full representation is read from VehicleListing (one PK join);
+    # sparse field lists are cheaper to serialize from narrowed columns.
+    if fields is None:
+        return VehicleMaster.objects.only("chassis_number", sort_field, "listing__data").select_related("listing")
+    return vehicle_queryset(fields, extra_columns=[sort_field])
+
+def _serialize_rows(rows, fields):
+    if fields is None:
+        return listing_data(rows)
+    return [serialize_vehicle(v, fields) for v in rows]
+
+# -------------------------------
+# Streaming full-fleet output
+# -------------------------------
+
+STREAM_CHUNK_SIZE = 500
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+def _iter_vehicle_chunks(qs, field="chassis_number", descending=False, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Walk a queryset in keyset-ordered chunks, yielding one list per chunk.
+
+    Each chunk is a separate bounded query, so prefetch_related lookups run
+    once per chunk and at most chunk_size model instances are alive at a time.
+    """
+    after = None
+    while True:
+        chunk = _seek_page(qs, field, descending, chunk_size, after)
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+        after = (getattr(last, field), last.pk)
+
+def _stream_format(request):
+    """Return "ndjson", "json" or None for the requested streaming mode."""
+    stream = (request.GET.get("stream") or "").lower()
+    if stream == "ndjson" or NDJSON_CONTENT_TYPE in request.META.get("HTTP_ACCEPT", ""):
+        return "ndjson"
+    if stream in ("1", "true", "json"):
+        return "json"
+    return None
+
+def _stream_vehicles(chunks, fmt, fields=None):
+    if fmt == "ndjson":
+        for chunk in chunks:
+            yield "".join(json.dumps(row) + "\n" for row in _serialize_rows(chunk, fields))
+        return
+
+    yield "["
+    first = True
+    for chunk in chunks:
+        encoded = ",".join(json.dumps(row) for row in _serialize_rows(chunk, fields))
+        yield encoded if first else "," + encoded
+        first = False
+    yield "]"
+
+# -------------------------------
+# Compact (dictionary-encoded) list format
+# -------------------------------
+
+# Lookup column -> model for the dictionaries sent with ?format=compact
+COMPACT_LOOKUPS = {
+    "vehicle_capacity": VehicleCapacity,
+    "vehicle_type": VehicleType,
+    "tote_capacity": ToteCapacity,
+    "status": Status,
+    "vehicle_concept": VehicleConcept,
+    "make": Make,
+    "emirates_permit": Emirate,
+    "gps": GPS,
+    "branding_status": BrandingStatus,
+    "tail_lift_brand": TailLiftBrand,
+}
+
+def _compact_vehicles(qs, params, fields=None, sort_field="chassis_number", descending=False):
+    """
+    Build the ?format=compact payload straight from values() rows.
+
+    Lookups are sent once as {id: name} dictionaries; each row is an array in
+    "columns" order holding lookup ids instead of {"id", "name"} objects and
+    a list of emirate ids for emirates_permit.
+    """
+    columns = fields or list(VEHICLE_FIELDS)
+    db_columns = ["chassis_number", sort_field]
+    for name in columns:
+        if VEHICLE_FIELDS[name].column:
+            db_columns.append(VEHICLE_FIELDS[name].column)
+    qs = qs.values(*dict.fromkeys(db_columns))
+
+    next_cursor = None
+    if _is_paginated(params):
+        rows, next_cursor = _paginate_vehicles(qs, params)
+        vehicle_ids = [r["chassis_number"] for r in rows]
+    else:
+        rows = _order_vehicles(qs, sort_field, descending).iterator(chunk_size=STREAM_CHUNK_SIZE)
+        vehicle_ids = qs.values("pk")
+
+    permits = {}
+    if "emirates_permit" in columns:
+        through = VehicleMaster.emirates_permit.through
+        links = through.objects.filter(vehiclemaster_id__in=vehicle_ids).order_by("emirate_id")
+        for vehicle_id, emirate_id in links.values_list("vehiclemaster_id", "emirate_id").iterator():
+            permits.setdefault(vehicle_id, []).append(emirate_id)
+
+    encoders = []
+    for name in columns:
+        spec = VEHICLE_FIELDS[name]
+        if spec.column is None:
+            encoders.append(lambda row: permits.get(row["chassis_number"], []))
+        elif spec.encode is None:
+            encoders.append(lambda row, column=spec.column: row[column])
+        else:
+            encoders.append(lambda row, column=spec.column, encode=spec.encode: encode(row[column]))
+
+    registry = lookups.get_registry()
+    dictionaries = {
+        name: {str(pk): label for pk, label in registry.names(model).items()}
+        for name, model in COMPACT_LOOKUPS.items()
+        if name in columns
+    }
+    payload = {
+        "columns": columns,
+        "lookups": dictionaries,
+        "rows": [[encode(row) for encode in encoders] for row in rows],
     }
+    if _is_paginated(params):
+        payload["next_cursor"] = next_cursor
+    return payload
 
-def _log_changes(request, v: VehicleMaster, before: dict, after: dict):
-    username = request.user.username if getattr(request, "user", None) and request.user.is_authenticated else None
-    for field, old in before.items():
-        new = after.get(field, "")
-        if (old or "") != (new or ""):
-            ChangeLog.objects.create(
-                date=date.today(),
-                time=datetime.now().time().replace(microsecond=0),
-                chassis_number=v.chassis_number,
-                plate_number=v.plate_number,
-                field_name=field,
-                old_value=old or "",
-                new_value=new or "",
-                username=username,
-            )
+# -------------------------------
+# Conditional GET driven by the fleet data version
+# -------------------------------
 
-def _parse_date(value):
-    if value is None or value == "":
-        return None
-    return parse_date(value)
+def _fleet_version(request):
+    # Memoized per request: condition() asks for the ETag and Last-Modified separately
+    if not hasattr(request, "_fleet_version"):
+        request._fleet_version = DataVersion.current(DataVersion.FLEET)
+    return request._fleet_version
 
-def _parse_int(value):
-    if value in (None, "", "null"):
-        return None
-    try:
-        return int(value)
-    except (ValueError, TypeError):
+def _cacheable(request):
+    return request.method in ("GET", "HEAD") and request.user.is_authenticated
+
+def _fleet_etag(request, *args, **kwargs):
+    """ETag for a read of fleet data: the fleet version plus the requested representation."""
+    if not _cacheable(request):
         return None
+    variant = f"{request.get_full_path()}|{request.META.get('HTTP_ACCEPT', '')}"
+    digest = hashlib.md5(variant.encode("utf-8")).hexdigest()[:12]
+    return f"fleet-{_fleet_version(request).version}-{digest}"
 
-def _get_fk(model, fk_id):
-    if fk_id in (None, "", "null"):
+def _fleet_last_modified(request, *args, **kwargs):
+    if not _cacheable(request):
         return None
-    try:
-        return model.objects.get(pk=int(fk_id))
-    except (ValueError, TypeError):
-        # Fall back if PK is non-integer type
-        return model.objects.get(pk=fk_id)
-
-def _apply_payload_to_instance(instance: VehicleMaster, data: dict, creating: bool):
-    # Required fields for creating a new row (non-file fields)
-    required_keys_for_create = [
-        "plate_number",
-        "vehicle_capacity_id",
-        "vehicle_type_id",
-        "tote_capacity_id",
-        "status_id",
-        "vehicle_concept_id",
-        "make_id",
-        "truck_reg_date",
-        "truck_registration_expiry_date",
-        "insurance_registration_date",
-        "insurance_registration_expiry_date",
-        "mulkia_registration_date",
-        "mulkia_registration_expiry_date",
-        "permit_registration_date",
-        "permit_registration_expiry_date",
-        "tl_no",
-        "tc_no",
-        "tc_owner",
-        "salik_account_no",
-        "salik_tag_no",
-        "darb_ac_no",
-        "gps_id",
-        "branding_status_id",
-        "lift_gate",
-        "tail_lift_brand_id",
-    ]
+    return _fleet_version(request).updated_at
 
-    if creating:
-        missing = [k for k in required_keys_for_create if k not in data]
-        if missing:
-            raise ValueError(f"Missing required fields for create: {', '.join(missing)}")
-
-    # Scalars
-    if "plate_number" in data:
-        instance.plate_number = data["plate_number"]
-
-    if "truck_reg_date" in data:
-        instance.truck_reg_date = _parse_date(data["truck_reg_date"])
-    if "truck_registration_expiry_date" in data:
-        instance.truck_registration_expiry_date = _parse_date(data["truck_registration_expiry_date"])
-
-    if "insurance_registration_date" in data:
-        instance.insurance_registration_date = _parse_date(data["insurance_registration_date"])
-    if "insurance_registration_expiry_date" in data:
-        instance.insurance_registration_expiry_date = _parse_date(data["insurance_registration_expiry_date"])
-
-    if "mulkia_registration_date" in data:
-        instance.mulkia_registration_date = _parse_date(data["mulkia_registration_date"])
-    if "mulkia_registration_expiry_date" in data:
-        instance.mulkia_registration_expiry_date = _parse_date(data["mulkia_registration_expiry_date"])
-
-    if "permit_registration_date" in data:
-        instance.permit_registration_date = _parse_date(data["permit_registration_date"])
-    if "permit_registration_expiry_date" in data:
-        instance.permit_registration_expiry_date = _parse_date(data["permit_registration_expiry_date"])
-
-    if "tl_no" in data:
-        _tl = _parse_int(data["tl_no"])
-        if _tl is not None:
-            instance.tl_no = _tl
-
-    if "tc_no" in data:
-        _tc = _parse_int(data["tc_no"])
-        if _tc is not None:
-            instance.tc_no = _tc
-
-    if "tc_owner" in data:
-        instance.tc_owner = data["tc_owner"]
-
-    if "salik_account_no" in data:
-        instance.salik_account_no = data["salik_account_no"]
-
-    if "salik_tag_no" in data:
-        instance.salik_tag_no = data["salik_tag_no"]
-
-    if "darb_ac_no" in data:
-        instance.darb_ac_no = data["darb_ac_no"]
-
-    if "lift_gate" in data:
-        val = data["lift_gate"]
-        if isinstance(val, str):
-            instance.lift_gate = val.lower() in ("true", "1", "on", "yes")
-        else:
-            instance.lift_gate = bool(val)
-
-    if "remarks" in data:
-        instance.remarks = data["remarks"]
-
-    # FKs by *_id
-    if "vehicle_capacity_id" in data:
-        if data["vehicle_capacity_id"] not in ("", None, "null"):
-            instance.vehicle_capacity = _get_fk(VehicleCapacity, data["vehicle_capacity_id"])
-    if "vehicle_type_id" in data:
-        if data["vehicle_type_id"] not in ("", None, "null"):
-            instance.vehicle_type = _get_fk(VehicleType, data["vehicle_type_id"])
-    if "tote_capacity_id" in data:
-        if data["tote_capacity_id"] not in ("", None, "null"):
-            instance.tote_capacity = _get_fk(ToteCapacity, data["tote_capacity_id"])
-    if "status_id" in data:
-        if data["status_id"] not in ("", None, "null"):
-            instance.status = _get_fk(Status, data["status_id"])
-    if "vehicle_concept_id" in data:
-        if data["vehicle_concept_id"] not in ("", None, "null"):
-            instance.vehicle_concept = _get_fk(VehicleConcept, data["vehicle_concept_id"])
-    if "make_id" in data:
-        if data["make_id"] not in ("", None, "null"):
-            instance.make = _get_fk(Make, data["make_id"])
-    if "gps_id" in data:
-        if data["gps_id"] not in ("", None, "null"):
-            instance.gps = _get_fk(GPS, data["gps_id"])
-    if "branding_status_id" in data:
-        if data["branding_status_id"] not in ("", None, "null"):
-            instance.branding_status = _get_fk(BrandingStatus, data["branding_status_id"])
-    if "tail_lift_brand_id" in data:
-        if data["tail_lift_brand_id"] not in ("", None, "null"):
-            instance.tail_lift_brand = _get_fk(TailLiftBrand, data["tail_lift_brand_id"])
-
-    # File fields excluded in JSON payload; keep existing on update.
-    # For create, set to empty strings to satisfy NOT NULL text columns.
-    if creating:
-        if not instance.insurance_document:
-            instance.insurance_document = ""
-        if not instance.mulkia_document:
-            instance.mulkia_document = ""
-        if not instance.permit_document:
-            instance.permit_document = ""
-        if not instance.truck_photos:
-            instance.truck_photos = ""
+def _conditional_get(**kwargs):
+    """
+    condition() applied to GET/HEAD only. Writes check If-Match against the
+    vehicle version themselves (see _if_match_failed).
+    """
+    decorator = condition(**kwargs)
 
+    def wrap(view):
+        conditional = decorator(view)
+
+        @wraps(view)
+        def inner(request, *args, **kw):
+            if request.method in ("GET", "HEAD"):
+                return conditional(request, *args, **kw)
+            return view(request, *args, **kw)
+        return inner
+    return wrap
+
+fleet_conditional = _conditional_get(etag_func=_fleet_etag, last_modified_func=_fleet_last_modified)
+
+# -------------------------------
+# Per-vehicle versions: ETags, If-Match and conflicts
+# -------------------------------
+
+ETAG_VERSION_RE = re.compile(r'^(?:W/)?"v(\d+)(?:-[0-9a-f]+)?"$')
+
+def _vehicle_version(request, chassis_number):
+    # Memoized per request: the ETag and the cached detail both need it
+    if not hasattr(request, "_vehicle_version"):
+        request._vehicle_version = (
+            VehicleMaster.objects.filter(pk=chassis_number).values_list("version", flat=True).first()
+        )
+    return request._vehicle_version
+
+def _vehicle_etag(request, chassis_number):
+    """ETag for one vehicle: its version, plus the representation if ?fields= narrows it."""
+    if not _cacheable(request):
+        return None
+    version = _vehicle_version(request, chassis_number)
+    if version is None:
+        return None
+    if not request.GET:
+        return f"v{version}"
+    digest = hashlib.md5(request.get_full_path().encode("utf-8")).hexdigest()[:12]
+    return f"v{version}-{digest}"
+
+vehicle_conditional = _conditional_get(etag_func=_vehicle_etag)
+
+def _version_conflict(version):
+    return JsonResponse({"error": "version conflict", "version": version}, status=412)
+
+def _if_match_failed(request, instance):
+    """
+    412 response if the request's If-Match names a different version of the
+    vehicle than the one loaded (or the vehicle does not exist), else None.
+    """
+    header = request.META.get("HTTP_IF_MATCH")
+    if not header:
+        return None
+    etags = parse_etags(header)
+    if instance is not None:
+        if "*" in etags:
+            return None
+        for etag in etags:
+            match = ETAG_VERSION_RE.match(etag)
+            if match and int(match.group(1)) == instance.version:
+                return None
+    return _version_conflict(instance.version if instance else None)
+
+def handles_version_conflicts(view):
+    """Turn a conditional update that lost a race into a 412 response."""
+    @wraps(view)
+    def inner(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except VersionConflict as e:
+            return _version_conflict(e.version)
+    return inner
+
+def _vehicle_written(status, instance):
+    response = JsonResponse({"status": status, "vehicle": serialize_vehicle(instance)})
+    response["ETag"] = f'"v{instance.version}"'
+    return response
+
+@cache_control(private=True, no_cache=True)
+@fleet_conditional
+@handles_version_conflicts
 def vehicle_master_api(request):
     if request.method == "GET":
-        qs = (
-            VehicleMaster.objects.select_related(
-                "vehicle_capacity",
-                "vehicle_type",
-                "tote_capacity",
-                "status",
-                "vehicle_concept",
-                "make",
-                "gps",
-                "branding_status",
-                "tail_lift_brand",
-            ).prefetch_related("emirates_permit")
-        )
-        data = [serialize_vehicle(v) for v in qs]
+        try:
+            fields = _parse_fields(request.GET)
+            field, descending = _parse_sort(request.GET.get("sort"))
+            if request.GET.get("format") == "compact":
+                qs = _filter_vehicles(VehicleMaster.objects.all(), request.GET)
+                return JsonResponse(_compact_vehicles(qs, request.GET, fields, field, descending))
+            qs = _filter_vehicles(_list_queryset(fields, field), request.GET)
+            if _is_paginated(request.GET):
+                rows, next_cursor = _paginate_vehicles(qs, request.GET)
+                return JsonResponse({
+                    "results": _serialize_rows(rows, fields),
+                    "next_cursor": next_cursor,
+                })
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        fmt = _stream_format(request)
+        if fmt:
+            return StreamingHttpResponse(
+                _stream_vehicles(_iter_vehicle_chunks(qs, field, descending), fmt, fields),
+                content_type=NDJSON_CONTENT_TYPE if fmt == "ndjson" else "application/json",
+            )
+        data = _serialize_rows(list(_order_vehicles(qs, field, descending)), fields)
         return JsonResponse(data, safe=False)
 
     if request.method == "POST":
@@ -386,11 +633,13 @@ def vehicle_master_api(request):
                 return HttpResponseBadRequest("chassis_number is required")
 
             with transaction.atomic():
-                existing = VehicleMaster.objects.select_for_update().filter(pk=chassis_number).first()
-                before = _snapshot_vehicle(existing) if existing else None
+                existing = load_vehicle(chassis_number)
+                failed = _if_match_failed(request, existing)
+                if failed:
+                    return failed
                 target = existing or VehicleMaster(chassis_number=chassis_number)
 
-                # Build a dict like the JSON payload expected by _apply_payload_to_instance
+                # Build a dict like the JSON payload expected by apply_payload
                 form_payload = {
                     "plate_number": request.POST.get("plate_number"),
                     "vehicle_capacity_id": request.POST.get("vehicle_capacity_id"),
@@ -420,7 +669,7 @@ def vehicle_master_api(request):
                     "remarks": request.POST.get("remarks"),
                 }
 
-                _apply_payload_to_instance(target, form_payload, creating=(existing is None))
+                apply_payload(target, form_payload, creating=(existing is None))
 
                 # Assign files if provided
                 if "insurance_document" in request.FILES:
@@ -432,11 +681,10 @@ def vehicle_master_api(request):
                 if "truck_photos" in request.FILES:
                     target.truck_photos = request.FILES["truck_photos"]
 
-                target.save()
+                changes = save_changes(target)
                 # Log changes if updating an existing vehicle
-                if existing and before is not None:
-                    after = _snapshot_vehicle(target)
-                    _log_changes(request, target, before, after)
+                if existing:
+                    log_changes(target, changes, _request_username(request))
 
                 # M2M emirates_permit
                 em_raw = request.POST.get("emirates_permit_ids")
@@ -451,9 +699,13 @@ def vehicle_master_api(request):
                             ids = [int(x) for x in str(em_raw).split(",") if x.strip()]
                         except Exception:
                             ids = []
-                    target.emirates_permit.set(Emirate.objects.filter(id__in=ids))
+                    permits_changed = set_permits(target, ids)
+                else:
+                    permits_changed = False
 
-                return JsonResponse({"status": "updated" if existing else "created", "vehicle": serialize_vehicle(target)})
+                if changes or permits_changed:
+                    vehicles_changed.send(sender=VehicleMaster, chassis_numbers=[target.pk])
+                return _vehicle_written("updated" if existing else "created", target)
         else:
             try:
                 payload = json.loads(request.body.decode("utf-8"))
@@ -465,52 +717,92 @@ def vehicle_master_api(request):
                 return HttpResponseBadRequest("chassis_number is required")
 
             with transaction.atomic():
-                existing = VehicleMaster.objects.select_for_update().filter(pk=chassis_number).first()
+                existing = load_vehicle(chassis_number)
+                failed = _if_match_failed(request, existing)
+                if failed:
+                    return failed
                 if existing:
-                    before = _snapshot_vehicle(existing)
-                    _apply_payload_to_instance(existing, payload, creating=False)
-                    existing.save()
-                    # Log changes after update
-                    after = _snapshot_vehicle(existing)
-                    _log_changes(request, existing, before, after)
+                    apply_payload(existing, payload, creating=False)
+                    changes = save_changes(existing)
+                    log_changes(existing, changes, _request_username(request))
                     # M2M
+                    permits_changed = False
                     if "emirates_permit_ids" in payload:
-                        ids = payload["emirates_permit_ids"] or []
-                        existing.emirates_permit.set(Emirate.objects.filter(id__in=ids))
-                    return JsonResponse({"status": "updated", "vehicle": serialize_vehicle(existing)})
+                        permits_changed = set_permits(existing, payload["emirates_permit_ids"] or [])
+                    if changes or permits_changed:
+                        vehicles_changed.send(sender=VehicleMaster, chassis_numbers=[existing.pk])
+                    return _vehicle_written("updated", existing)
                 else:
                     instance = VehicleMaster(chassis_number=chassis_number)
-                    _apply_payload_to_instance(instance, payload, creating=True)
+                    apply_payload(instance, payload, creating=True)
                     instance.save()
                     # M2M
                     if "emirates_permit_ids" in payload:
-                        ids = payload["emirates_permit_ids"] or []
-                        instance.emirates_permit.set(Emirate.objects.filter(id__in=ids))
-                    return JsonResponse({"status": "created", "vehicle": serialize_vehicle(instance)})
+                        set_permits(instance, payload["emirates_permit_ids"] or [])
+                    vehicles_changed.send(sender=VehicleMaster, chassis_numbers=[instance.pk])
+                    return _vehicle_written("created", instance)
 
     return HttpResponseNotAllowed(["GET", "POST"])
 
+VEHICLE_DETAIL_CACHE_TIMEOUT = 60 * 60
+
+def _vehicle_detail(request, chassis_number):
+    """
+    Full representation of one vehicle, cached per chassis. The key carries
+    the vehicle version, so every write to it invalidates the entry in all
+    worker processes. Only a body of that same version is cached: the
+    listing is refreshed after the write commits, so for a moment it can
+    still hold the previous version.
+    """
+    version = _vehicle_version(request, chassis_number)
+    if version is None:
+        return None
+    key = f"vehicle-detail:{chassis_number}:{version}"
+    data = cache.get(key)
+    if data is None:
+        data = VehicleListing.objects.filter(pk=chassis_number).values_list("data", flat=True).first()
+        if data is None or data.get("version") != version:
+            instance = load_vehicle(chassis_number)
+            if instance is None:
+                return None
+            data = serialize_vehicle(instance)
+        if data["version"] == version:
+            cache.set(key, data, VEHICLE_DETAIL_CACHE_TIMEOUT)
+    return data
+
+@cache_control(private=True, no_cache=True)
+@vehicle_conditional
+@handles_version_conflicts
 def vehicle_master_detail_api(request, chassis_number: str):
     if not request.user.is_authenticated:
         return JsonResponse({"error": "unauthorized"}, status=401)
 
     if request.method == "GET":
         try:
-            instance = VehicleMaster.objects.get(pk=chassis_number)
-        except VehicleMaster.DoesNotExist:
+            fields = _parse_fields(request.GET)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        if fields is None:
+            data = _vehicle_detail(request, chassis_number)
+        else:
+            instance = vehicle_queryset(fields).filter(pk=chassis_number).first()
+            data = serialize_vehicle(instance, fields) if instance else None
+        if data is None:
             return HttpResponseBadRequest("VehicleMaster not found")
-        return JsonResponse(serialize_vehicle(instance))
+        return JsonResponse(data)
 
     if request.method == "PUT":
         content_type = request.META.get("CONTENT_TYPE", "")
         is_multipart = content_type.startswith("multipart/form-data")
 
         with transaction.atomic():
-            try:
-                instance = VehicleMaster.objects.select_for_update().get(pk=chassis_number)
-                before = _snapshot_vehicle(instance)
-            except VehicleMaster.DoesNotExist:
+            instance = load_vehicle(chassis_number)
+            if instance is None:
                 return HttpResponseBadRequest("VehicleMaster not found")
+            failed = _if_match_failed(request, instance)
+            if failed:
+                return failed
+            permits_changed = False
 
             if is_multipart:
                 form_payload = {
@@ -541,7 +833,7 @@ def vehicle_master_detail_api(request, chassis_number: str):
                     "tail_lift_brand_id": request.POST.get("tail_lift_brand_id"),
                     "remarks": request.POST.get("remarks"),
                 }
-                _apply_payload_to_instance(instance, form_payload, creating=False)
+                apply_payload(instance, form_payload, creating=False)
 
                 # Files
                 if "insurance_document" in request.FILES:
@@ -553,9 +845,8 @@ def vehicle_master_detail_api(request, chassis_number: str):
                 if "truck_photos" in request.FILES:
                     instance.truck_photos = request.FILES["truck_photos"]
 
-                instance.save()
-                after = _snapshot_vehicle(instance)
-                _log_changes(request, instance, before, after)
+                changes = save_changes(instance)
+                log_changes(instance, changes, _request_username(request))
 
                 # M2M emirates_permit
                 em_raw = request.POST.get("emirates_permit_ids")
@@ -570,63 +861,617 @@ def vehicle_master_detail_api(request, chassis_number: str):
                             ids = [int(x) for x in str(em_raw).split(",") if x.strip()]
                         except Exception:
                             ids = []
-                    instance.emirates_permit.set(Emirate.objects.filter(id__in=ids))
+                    permits_changed = set_permits(instance, ids)
             else:
                 try:
                     payload = json.loads(request.body.decode("utf-8"))
                 except Exception:
                     return HttpResponseBadRequest("Invalid JSON body")
 
-                _apply_payload_to_instance(instance, payload, creating=False)
-                instance.save()
-                after = _snapshot_vehicle(instance)
-                _log_changes(request, instance, before, after)
+                apply_payload(instance, payload, creating=False)
+                changes = save_changes(instance)
+                log_changes(instance, changes, _request_username(request))
                 if "emirates_permit_ids" in payload:
-                    ids = payload["emirates_permit_ids"] or []
-                    instance.emirates_permit.set(Emirate.objects.filter(id__in=ids))
+                    permits_changed = set_permits(instance, payload["emirates_permit_ids"] or [])
 
-            return JsonResponse({"status": "updated", "vehicle": serialize_vehicle(instance)})
+            if changes or permits_changed:
+                vehicles_changed.send(sender=VehicleMaster, chassis_numbers=[instance.pk])
+            return _vehicle_written("updated", instance)
 
     return HttpResponseNotAllowed(["GET", "PUT"])
 
-def dropdowns_api(request):
+# -------------------------------
+# Full-text search
+# -------------------------------
+
+@cache_control(private=True, no_cache=True)
+@fleet_conditional
+def vehicle_search_api(request):
+    """
+    Ranked prefix search: ?q=dxb 123&limit=20&offset=0. Returns
+    {"results": [...], "next_offset": n or null}; ?fields= applies.
+    """
     if request.method != "GET":
         return HttpResponseNotAllowed(["GET"])
     if not request.user.is_authenticated:
         return JsonResponse({"error": "unauthorized"}, status=401)
 
-    def _ser(qs):
-        return [{"id": obj.id, "name": obj.name} for obj in qs.order_by("name")]
+    try:
+        fields = _parse_fields(request.GET)
+        limit = min(parse_int_or_none(request.GET.get("limit")) or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        offset = parse_int_or_none(request.GET.get("offset")) or 0
+        if limit < 1 or offset < 0:
+            raise ValueError("limit and offset must be positive")
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    term = request.GET.get("q") or ""
+    if search.is_supported():
+        ranked = search.search_vehicles(term, limit + 1, offset)
+    else:
+        matches = _filter_vehicles(VehicleMaster.objects.order_by("pk"), {"q": term}) if term.strip() else VehicleMaster.objects.none()
+        ranked = list(matches.values_list("pk", flat=True)[offset:offset + limit + 1])
+
+    next_offset = offset + limit if len(ranked) > limit else None
+    ranked = ranked[:limit]
+    vehicles = {v.pk: v for v in _list_queryset(fields, "chassis_number").filter(pk__in=ranked)}
+    rows = [vehicles[pk] for pk in ranked if pk in vehicles]
+    return JsonResponse({"results": _serialize_rows(rows, fields), "next_offset": next_offset})
+
+# -------------------------------
+# Bulk upsert
+# -------------------------------
+
+BULK_MAX_VEHICLES = 1000
+
+def vehicle_bulk_api(request):
+    """
+    POST a JSON array of vehicle payloads (the same shape vehicle_master_api
+    accepts) to create or update up to BULK_MAX_VEHICLES vehicles at once.
+    Responds with per-item results: created / updated / unchanged / error.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "unauthorized"}, status=401)
+
+    try:
+        items = json.loads(request.body.decode("utf-8"))
+    except Exception:
+        return HttpResponseBadRequest("Invalid JSON body")
+    if not isinstance(items, list):
+        return HttpResponseBadRequest("Expected a JSON array of vehicles")
+    if len(items) > BULK_MAX_VEHICLES:
+        return HttpResponseBadRequest(f"At most {BULK_MAX_VEHICLES} vehicles per request")
+
+    username = request.user.username
+    try:
+        results = bulk_upsert_vehicles(items, username)
+    except IntegrityError as e:
+        # A concurrent writer created one of these vehicles or plates first
+        return JsonResponse({"error": str(e)}, status=409)
+
+    counts = {status: 0 for status in ("created", "updated", "unchanged", "error")}
+    for result in results:
+        counts[result["status"]] += 1
+    return JsonResponse({**counts, "results": results})
 
+# -------------------------------
+# Change log API
+# -------------------------------
+
+CHANGE_LOG_PAGE_SIZE = 100
+
+def _prefix_q(field, prefix):
+    # A range rather than LIKE, so the (field, timestamp) indexes apply
+    return Q(**{f"{field}__gte": prefix, f"{field}__lt": prefix + "\U0010ffff"})
+
+def _local_day_start(value, param):
+    day = parse_date_or_none(value)
+    if day is None:
+        raise ValueError(f"Invalid date for {param}: {value}")
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
+
+def _filter_changesets(qs, params):
+    """
+    Server-side change log filters: exact chassis_number, chassis / plate /
+    user prefixes ("starts with"; case-insensitive for chassis and plate,
+    through the UPPER() indexes), a changed field and a local date range
+    (both ends inclusive). Raises ValueError for malformed dates.
+    """
+    if params.get("chassis_number"):
+        qs = qs.filter(chassis_number=params["chassis_number"])
+    if params.get("chassis"):
+        qs = qs.alias(chassis_upper=Upper("chassis_number"))
+        qs = qs.filter(_prefix_q("chassis_upper", params["chassis"].strip().upper()))
+    if params.get("plate"):
+        qs = qs.alias(plate_upper=Upper("plate_number"))
+        qs = qs.filter(_prefix_q("plate_upper", params["plate"].strip().upper()))
+    if params.get("user"):
+        qs = qs.filter(_prefix_q("username", params["user"].strip()))
+    if params.get("field"):
+        qs = qs.filter(changes__has_key=params["field"])
+    if params.get("date_from"):
+        qs = qs.filter(timestamp__gte=_local_day_start(params["date_from"], "date_from"))
+    if params.get("date_to"):
+        qs = qs.filter(timestamp__lt=_local_day_start(params["date_to"], "date_to") + timedelta(days=1))
+    return qs
+
+def _archived_matches(params, before=None):
+    """
+    Archived ChangeSets matching the _filter_changesets params, newest
+    first, strictly before the (timestamp, id) position `before`. The
+    archive only holds rows older than every live one, so this continues
+    a live listing where it runs out.
+    """
+    chassis_number = params.get("chassis_number")
+    chassis = (params.get("chassis") or "").strip().upper()
+    plate = (params.get("plate") or "").strip().upper()
+    user = (params.get("user") or "").strip()
+    field = params.get("field")
+    after = None
+    if params.get("date_from"):
+        after = _local_day_start(params["date_from"], "date_from") - timedelta(microseconds=1)
+    if params.get("date_to"):
+        # id 0 sorts before every real id, so this bounds the timestamp alone
+        end = (_local_day_start(params["date_to"], "date_to") + timedelta(days=1), 0)
+        before = min(before, end) if before else end
+
+    changesets = archive.iter_archived(
+        before=before,
+        after=after,
+        chassis_numbers=[chassis_number] if chassis_number else None,
+        username_prefix=user,
+    )
+    for changeset in changesets:
+        if chassis_number and changeset.chassis_number != chassis_number:
+            continue
+        if not changeset.chassis_number.upper().startswith(chassis):
+            continue
+        if not (changeset.plate_number or "").upper().startswith(plate):
+            continue
+        if not (changeset.username or "").startswith(user):
+            continue
+        if field and field not in changeset.changes:
+            continue
+        yield changeset
+
+def _encode_change_cursor(changeset):
+    raw = json.dumps({"t": changeset.timestamp.isoformat(), "k": changeset.id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_change_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        decoded = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return datetime.fromisoformat(decoded["t"]), int(decoded["k"])
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def _change_entries(changesets, field=None):
+    return [
+        entry for changeset in changesets for entry in changeset.entries()
+        if field is None or entry.field_name == field
+    ]
+
+def _change_log_page(params):
+    """
+    One page of change log entries, newest first, and the cursor for the
+    next page (None on the last). Pages are keyset seeks on (timestamp, id)
+    and hold up to `limit` changesets, each expanding to one entry per
+    changed field. Once the live table runs out, paging continues into the
+    cold archive with the same filters and cursor.
+    """
+    limit = parse_int_or_none(params.get("limit")) or CHANGE_LOG_PAGE_SIZE
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    qs = _filter_changesets(ChangeSet.objects.all(), params).order_by("-timestamp", "-id")
+    position = None
+    if params.get("cursor"):
+        position = _decode_change_cursor(params["cursor"])
+        timestamp, pk = position
+        qs = qs.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+
+    changesets = list(qs[:limit + 1])
+    if len(changesets) <= limit:
+        changesets += itertools.islice(_archived_matches(params, position), limit + 1 - len(changesets))
+    next_cursor = None
+    if len(changesets) > limit:
+        changesets = changesets[:limit]
+        next_cursor = _encode_change_cursor(changesets[-1])
+    return _change_entries(changesets, params.get("field") or None), next_cursor
+
+def _iter_filtered_changesets(qs, params, chunk_size=STREAM_CHUNK_SIZE):
+    """Chunks of every ChangeSet matching params, newest first, live then archived."""
+    page = qs.order_by("-timestamp", "-id")
+    while True:
+        chunk = list(page[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        last = chunk[-1]
+        page = qs.filter(Q(timestamp__lt=last.timestamp) | Q(timestamp=last.timestamp, id__lt=last.id)).order_by("-timestamp", "-id")
+    archived = _archived_matches(params)
+    while True:
+        chunk = list(itertools.islice(archived, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+@cache_control(private=True, no_cache=True)
+def change_log_api(request):
+    """
+    GET filtered change log entries, newest first: ?chassis_number= ?chassis=
+    ?plate= ?user= ?field= ?date_from= ?date_to= with ?limit= / ?cursor=
+    keyset paging. ?format=csv streams every matching entry instead.
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "unauthorized"}, status=401)
+
+    field = request.GET.get("field") or None
+    try:
+        if request.GET.get("format") == "csv":
+            qs = _filter_changesets(ChangeSet.objects.all(), request.GET)
+            rows = (_change_entries(chunk, field) for chunk in _iter_filtered_changesets(qs, request.GET))
+            response = StreamingHttpResponse(exports.iter_csv(rows, exports.CHANGE_LOG_COLUMNS), content_type="text/csv")
+            response["Content-Disposition"] = 'attachment; filename="change_log.csv"'
+            return response
+        entries, next_cursor = _change_log_page(request.GET)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return JsonResponse({"results": [entry._asdict() for entry in entries], "next_cursor": next_cursor})
+
+@cache_control(private=True, no_cache=True)
+def vehicle_history_api(request, chassis_number):
+    """GET one vehicle's change history, newest first, with ?limit= / ?cursor= paging."""
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "unauthorized"}, status=401)
+    params = {"chassis_number": chassis_number, "limit": request.GET.get("limit"), "cursor": request.GET.get("cursor")}
+    try:
+        entries, next_cursor = _change_log_page(params)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return JsonResponse({"results": [entry._asdict() for entry in entries], "next_cursor": next_cursor})
+
+# -------------------------------
+# Point-in-time ("as of") reads
+# -------------------------------
+
+def _parse_as_of(value):
+    """?at= as an aware datetime; a bare date means the end of that local day."""
+    if not value:
+        raise ValueError("at is required")
+    try:
+        day = parse_date_or_none(value)
+        if day is not None:
+            at = datetime.combine(day, datetime.max.time())
+        else:
+            at = parse_datetime(value)
+            if at is None:
+                raise ValueError
+    except ValueError:
+        raise ValueError(f"Invalid timestamp for at: {value}")
+    if timezone.is_naive(at):
+        at = timezone.make_aware(at)
+    return at
+
+@cache_control(private=True, no_cache=True)
+def vehicle_as_of_api(request, chassis_number):
+    """GET ?at=<ISO date or datetime>: the vehicle's logged fields as they were then."""
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "unauthorized"}, status=401)
+    try:
+        at = _parse_as_of(request.GET.get("at"))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    result = history.vehicle_as_of(chassis_number, at)
+    if result is None:
+        return JsonResponse({"error": "not found"}, status=404)
+    state, info = result
+    return JsonResponse({"chassis_number": chassis_number, "as_of": at.isoformat(), "vehicle": state, **info})
+
+@cache_control(private=True, no_cache=True)
+def fleet_as_of_api(request):
+    """GET ?at=...&format=csv|ndjson: every current vehicle as it was at that time, streamed."""
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "unauthorized"}, status=401)
+    try:
+        at = _parse_as_of(request.GET.get("at"))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    fmt = request.GET.get("format", "csv")
+    chunks = history.iter_fleet_as_of(at)
+    if fmt == "csv":
+        response = StreamingHttpResponse(exports.iter_csv(chunks, history.AS_OF_COLUMNS), content_type="text/csv")
+        response["Content-Disposition"] = f'attachment; filename="vehicle_master_as_of_{at.date().isoformat()}.csv"'
+        return response
+    if fmt == "ndjson":
+        return StreamingHttpResponse(exports.iter_ndjson(chunks, history.AS_OF_COLUMNS), content_type=NDJSON_CONTENT_TYPE)
+    return HttpResponseBadRequest(f"Unknown export format: {fmt}")
+
+# -------------------------------
+# CSV import
+# -------------------------------
+
+IMPORT_MAX_REPORTED_ERRORS = 500
+
+def vehicle_import_api(request):
+    """
+    POST a CSV file (multipart field "file") to create or update vehicles;
+    see imports.py for the columns. ?dry_run=1 validates without saving.
+    Responds with counts and the first IMPORT_MAX_REPORTED_ERRORS rejected rows.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "unauthorized"}, status=401)
+    upload = request.FILES.get("file")
+    if upload is None:
+        return HttpResponseBadRequest("Expected a CSV file in the 'file' field")
+    dry_run = (request.POST.get("dry_run") or request.GET.get("dry_run", "")).lower() in ("1", "true", "yes", "on")
+
+    errors = []
+    def on_error(line, chassis_number, row_errors):
+        if len(errors) < IMPORT_MAX_REPORTED_ERRORS:
+            errors.append({"line": line, "chassis_number": chassis_number, "errors": row_errors})
+
+    text = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
+    try:
+        counts = import_vehicles(text, username=request.user.username, dry_run=dry_run, on_error=on_error)
+    except CSVFormatError as e:
+        return HttpResponseBadRequest(str(e))
+    except IntegrityError as e:
+        # A concurrent writer created one of these vehicles or plates first
+        return JsonResponse({"error": str(e)}, status=409)
+    finally:
+        text.detach()
+    return JsonResponse({
+        **counts,
+        "dry_run": dry_run,
+        "errors": errors,
+        "errors_truncated": counts["error"] > len(errors),
+    })
+
+# -------------------------------
+# Fleet statistics
+# -------------------------------
+
+FLEET_STATS_CACHE_TIMEOUT = 60 * 60
+
+def _breakdown(qs, key):
+    rows = qs.values(f"{key}_id", f"{key}__name").annotate(count=Count("pk")).order_by("-count", f"{key}__name")
+    return [{"id": r[f"{key}_id"], "name": r[f"{key}__name"], "count": r["count"]} for r in rows]
+
+def _compute_fleet_stats():
+    vehicles = VehicleMaster.objects.all()
+    totals = vehicles.aggregate(
+        total=Count("pk"),
+        active=Count("pk", filter=Q(status__name__icontains="active")),
+        with_gps=Count("pk", filter=Q(gps__isnull=False) & ~Q(gps__name="")),
+        with_lift_gate=Count("pk", filter=Q(lift_gate=True)),
+    )
+    through = VehicleMaster.emirates_permit.through
+    emirates = (
+        through.objects.values("emirate_id", "emirate__name")
+        .annotate(count=Count("vehiclemaster_id"))
+        .order_by("-count", "emirate__name")
+    )
+    return {
+        **totals,
+        "by_status": _breakdown(vehicles, "status"),
+        "by_make": _breakdown(vehicles, "make"),
+        "by_vehicle_type": _breakdown(vehicles, "vehicle_type"),
+        "by_emirate": [{"id": r["emirate_id"], "name": r["emirate__name"], "count": r["count"]} for r in emirates],
+    }
+
+@cache_control(private=True, no_cache=True)
+@fleet_conditional
+def vehicle_stats_api(request):
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "unauthorized"}, status=401)
+
+    # Keyed by the fleet version, so any vehicle or lookup write invalidates it
+    key = f"fleet-stats:{_fleet_version(request).version}"
+    data = cache.get_or_set(key, _compute_fleet_stats, FLEET_STATS_CACHE_TIMEOUT)
+    if request.GET:
+        # List API filters (?q=, ?status=, ...) add the number of vehicles they match
+        try:
+            data = {**data, "matching": _filter_vehicles(VehicleMaster.objects.all(), request.GET).count()}
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+    return JsonResponse(data)
+
+@cache_control(private=True, no_cache=True)
+@fleet_conditional
+def dropdowns_api(request):
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "unauthorized"}, status=401)
+
+    registry = lookups.get_registry()
     data = {
-        "vehicle_capacities": _ser(VehicleCapacity.objects.all()),
-        "vehicle_types": _ser(VehicleType.objects.all()),
-        "tote_capacities": _ser(ToteCapacity.objects.all()),
-        "statuses": _ser(Status.objects.all()),
-        "vehicle_concepts": _ser(VehicleConcept.objects.all()),
-        "makes": _ser(Make.objects.all()),
-        "emirates": _ser(Emirate.objects.all()),
-        "gps_list": _ser(GPS.objects.all()),
-        "branding_statuses": _ser(BrandingStatus.objects.all()),
-        "tail_lift_brands": _ser(TailLiftBrand.objects.all()),
+        "vehicle_capacities": registry.options(VehicleCapacity),
+        "vehicle_types": registry.options(VehicleType),
+        "tote_capacities": registry.options(ToteCapacity),
+        "statuses": registry.options(Status),
+        "vehicle_concepts": registry.options(VehicleConcept),
+        "makes": registry.options(Make),
+        "emirates": registry.options(Emirate),
+        "gps_list": registry.options(GPS),
+        "branding_statuses": registry.options(BrandingStatus),
+        "tail_lift_brands": registry.options(TailLiftBrand),
     }
     return JsonResponse(data)
 
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
 @login_required(login_url='login')
 def download_csv(request):
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="vehicle_master.csv"'
+    """The vehicle export as ?format=csv (default), xlsx or ndjson (gzip-compressed)."""
+    fmt = request.GET.get('format', 'csv')
+    if fmt == 'csv':
+        response = StreamingHttpResponse(exports.iter_csv(exports.iter_export_rows()), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="vehicle_master.csv"'
+        return response
+    if fmt == 'ndjson':
+        chunks = exports.iter_ndjson(exports.iter_export_rows())
+        response = StreamingHttpResponse(exports.iter_gzip(chunks), content_type='application/gzip')
+        response['Content-Disposition'] = 'attachment; filename="vehicle_master.ndjson.gz"'
+        return response
+    if fmt == 'xlsx':
+        if not exports.xlsx_supported():
+            return HttpResponse("XLSX export needs the openpyxl package", status=501)
+        # The zip container can only be finished once every row is in, so
+        # the workbook is built in a temporary file and streamed from there
+        workbook = tempfile.TemporaryFile()
+        exports.write_xlsx(exports.iter_export_rows(), workbook)
+        workbook.seek(0)
+        return FileResponse(workbook, as_attachment=True, filename="vehicle_master.xlsx", content_type=XLSX_CONTENT_TYPE)
+    return HttpResponseBadRequest(f"Unknown export format: {fmt}")
 
-    writer = csv.writer(response)
-    
-    # Get all field names from the VehicleMaster model
-    field_names = [field.name for field in VehicleMaster._meta.get_fields() if not field.is_relation or field.one_to_one or (field.many_to_one and field.related_model)]
-    writer.writerow(field_names)
+# -------------------------------
+# Export jobs
+# -------------------------------
 
-    vehicles = VehicleMaster.objects.all().values_list(*field_names)
-    for vehicle in vehicles:
-        writer.writerow(vehicle)
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
 
+def _export_job_data(job):
+    data = {
+        "id": job.pk,
+        "kind": job.kind,
+        "format": job.format,
+        "status": job.status,
+        "data_version": job.data_version,
+        "rows_done": job.rows_done,
+        "rows_total": job.rows_total,
+        "progress": round(job.rows_done / job.rows_total, 3) if job.rows_total else None,
+        "size": job.size,
+        "error": job.error or None,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "status_url": reverse("export_job_api", args=[job.pk]),
+        "download_url": None,
+    }
+    if job.status == ExportJob.DONE:
+        data["download_url"] = reverse("export_job_download", args=[job.pk])
+    return data
+
+def export_jobs_api(request):
+    """
+    POST {"kind": "vehicles" | "change_log", "format": "csv" | "ndjson"} to
+    request an export. Answers 200 with the finished job when the current
+    data has already been exported, otherwise 202 with the queued or
+    running job to poll at status_url.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "unauthorized"}, status=401)
+    if request.content_type == "application/json":
+        try:
+            params = json.loads(request.body.decode("utf-8") or "{}")
+        except Exception:
+            return HttpResponseBadRequest("Invalid JSON body")
+        if not isinstance(params, dict):
+            return HttpResponseBadRequest("Expected a JSON object")
+    else:
+        params = request.POST
+    kind = params.get("kind") or ExportJob.VEHICLES
+    fmt = params.get("format") or ExportJob.CSV
+    if kind not in dict(ExportJob.KIND_CHOICES):
+        return HttpResponseBadRequest(f"Unknown export kind: {kind}")
+    if fmt not in dict(ExportJob.FORMAT_CHOICES):
+        return HttpResponseBadRequest(f"Unknown export format: {fmt}")
+
+    job, _ = export_jobs.request_export(kind, fmt, request.user)
+    return JsonResponse(_export_job_data(job), status=200 if job.status == ExportJob.DONE else 202)
+
+@cache_control(private=True, no_cache=True)
+def export_job_api(request, job_id):
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "unauthorized"}, status=401)
+    job = ExportJob.objects.filter(pk=job_id).first()
+    if job is None:
+        return JsonResponse({"error": "not found"}, status=404)
+    return JsonResponse(_export_job_data(job))
+
+def _byte_range(header, size):
+    """(start, end) for a single "bytes=" range, None to ignore it, or False if unsatisfiable."""
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, end
+
+def _read_file(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(DOWNLOAD_BLOCK_SIZE, length))
+            if not block:
+                return
+            length -= len(block)
+            yield block
+
+@cache_control(private=True)
+def export_job_download(request, job_id):
+    """The gzip artifact of a finished job; supports single byte ranges for resumed downloads."""
+    if request.method not in ("GET", "HEAD"):
+        return HttpResponseNotAllowed(["GET", "HEAD"])
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "unauthorized"}, status=401)
+    job = ExportJob.objects.filter(pk=job_id, status=ExportJob.DONE).first()
+    path = export_jobs.artifact_path(job) if job else None
+    if path is None or not path.exists():
+        return JsonResponse({"error": "not found"}, status=404)
+
+    size = path.stat().st_size
+    etag = f'"export-{job.pk}"'
+    byte_range = None
+    if "HTTP_RANGE" in request.META and request.META.get("HTTP_IF_RANGE", etag) == etag:
+        byte_range = _byte_range(request.META["HTTP_RANGE"], size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    start, end = byte_range or (0, size - 1)
+    length = end - start + 1 if size else 0
+    body = _read_file(path, start, length) if request.method == "GET" else []
+    response = StreamingHttpResponse(body, status=206 if byte_range else 200, content_type="application/gzip")
+    if byte_range:
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response["Content-Length"] = str(length)
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    extension = "csv" if job.format == ExportJob.CSV else "ndjson"
+    response["Content-Disposition"] = f'attachment; filename="{job.kind}-{job.data_version}.{extension}.gz"'
     return response
 
 @login_required(login_url='login')
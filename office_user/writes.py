@@ -0,0 +1,447 @@
+"""
+Vehicle write path shared by the JSON API, the bulk endpoint and the CSV
+import: payload parsing, dirty-field saves, permit updates, change-log
+rows and the batched upsert engine.
+"""
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import transaction
+from django.db.models import F, FileField
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from datetime import date
+import copy
+
+from .models import (
+    VehicleMaster,
+    VehicleCapacity,
+    VehicleType,
+    ToteCapacity,
+    Status,
+    VehicleConcept,
+    Make,
+    Emirate,
+    GPS,
+    BrandingStatus,
+    TailLiftBrand,
+    ChangeSet,
+)
+from .serializers import storage_url_or_none
+from .signals import vehicles_changed
+from . import lookups
+
+# -------------------------------
+# Payload parsing
+# -------------------------------
+
+def parse_date_or_none(value):
+    if value is None or value == "":
+        return None
+    return parse_date(value)
+
+def parse_int_or_none(value):
+    if value in (None, "", "null"):
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+def _get_fk(model, fk_id):
+    if fk_id in (None, "", "null"):
+        return None
+    return lookups.resolve(model, fk_id)
+
+def apply_payload(instance: VehicleMaster, data: dict, creating: bool):
+    # Required fields for creating a new row (non-file fields)
+    required_keys_for_create = [
+        "plate_number",
+        "vehicle_capacity_id",
+        "vehicle_type_id",
+        "tote_capacity_id",
+        "status_id",
+        "vehicle_concept_id",
+        "make_id",
+        "truck_reg_date",
+        "truck_registration_expiry_date",
+        "insurance_registration_date",
+        "insurance_registration_expiry_date",
+        "mulkia_registration_date",
+        "mulkia_registration_expiry_date",
+        "permit_registration_date",
+        "permit_registration_expiry_date",
+        "tl_no",
+        "tc_no",
+        "tc_owner",
+        "salik_account_no",
+        "salik_tag_no",
+        "darb_ac_no",
+        "gps_id",
+        "branding_status_id",
+        "lift_gate",
+        "tail_lift_brand_id",
+    ]
+
+    if creating:
+        missing = [k for k in required_keys_for_create if k not in data]
+        if missing:
+            raise ValueError(f"Missing required fields for create: {', '.join(missing)}")
+
+    # Scalars
+    if "plate_number" in data:
+        instance.plate_number = data["plate_number"]
+
+    if "truck_reg_date" in data:
+        instance.truck_reg_date = parse_date_or_none(data["truck_reg_date"])
+    if "truck_registration_expiry_date" in data:
+        instance.truck_registration_expiry_date = parse_date_or_none(data["truck_registration_expiry_date"])
+
+    if "insurance_registration_date" in data:
+        instance.insurance_registration_date = parse_date_or_none(data["insurance_registration_date"])
+    if "insurance_registration_expiry_date" in data:
+        instance.insurance_registration_expiry_date = parse_date_or_none(data["insurance_registration_expiry_date"])
+
+    if "mulkia_registration_date" in data:
+        instance.mulkia_registration_date = parse_date_or_none(data["mulkia_registration_date"])
+    if "mulkia_registration_expiry_date" in data:
+        instance.mulkia_registration_expiry_date = parse_date_or_none(data["mulkia_registration_expiry_date"])
+
+    if "permit_registration_date" in data:
+        instance.permit_registration_date = parse_date_or_none(data["permit_registration_date"])
+    if "permit_registration_expiry_date" in data:
+        instance.permit_registration_expiry_date = parse_date_or_none(data["permit_registration_expiry_date"])
+
+    if "tl_no" in data:
+        _tl = parse_int_or_none(data["tl_no"])
+        if _tl is not None:
+            instance.tl_no = _tl
+
+    if "tc_no" in data:
+        _tc = parse_int_or_none(data["tc_no"])
+        if _tc is not None:
+            instance.tc_no = _tc
+
+    if "tc_owner" in data:
+        instance.tc_owner = data["tc_owner"]
+
+    if "salik_account_no" in data:
+        instance.salik_account_no = data["salik_account_no"]
+
+    if "salik_tag_no" in data:
+        instance.salik_tag_no = data["salik_tag_no"]
+
+    if "darb_ac_no" in data:
+        instance.darb_ac_no = data["darb_ac_no"]
+
+    if "lift_gate" in data:
+        val = data["lift_gate"]
+        if isinstance(val, str):
+            instance.lift_gate = val.lower() in ("true", "1", "on", "yes")
+        else:
+            instance.lift_gate = bool(val)
+
+    if "remarks" in data:
+        # NULL and "" both mean no remarks (an exported blank cell is either);
+        # a blank value keeps whichever the row stores, so it is not a change
+        if data["remarks"] not in ("", None) or instance.remarks not in ("", None):
+            instance.remarks = data["remarks"]
+
+    # FKs by *_id
+    if "vehicle_capacity_id" in data:
+        if data["vehicle_capacity_id"] not in ("", None, "null"):
+            instance.vehicle_capacity_id = _get_fk(VehicleCapacity, data["vehicle_capacity_id"])
+    if "vehicle_type_id" in data:
+        if data["vehicle_type_id"] not in ("", None, "null"):
+            instance.vehicle_type_id = _get_fk(VehicleType, data["vehicle_type_id"])
+    if "tote_capacity_id" in data:
+        if data["tote_capacity_id"] not in ("", None, "null"):
+            instance.tote_capacity_id = _get_fk(ToteCapacity, data["tote_capacity_id"])
+    if "status_id" in data:
+        if data["status_id"] not in ("", None, "null"):
+            instance.status_id = _get_fk(Status, data["status_id"])
+    if "vehicle_concept_id" in data:
+        if data["vehicle_concept_id"] not in ("", None, "null"):
+            instance.vehicle_concept_id = _get_fk(VehicleConcept, data["vehicle_concept_id"])
+    if "make_id" in data:
+        if data["make_id"] not in ("", None, "null"):
+            instance.make_id = _get_fk(Make, data["make_id"])
+    if "gps_id" in data:
+        if data["gps_id"] not in ("", None, "null"):
+            instance.gps_id = _get_fk(GPS, data["gps_id"])
+    if "branding_status_id" in data:
+        if data["branding_status_id"] not in ("", None, "null"):
+            instance.branding_status_id = _get_fk(BrandingStatus, data["branding_status_id"])
+    if "tail_lift_brand_id" in data:
+        if data["tail_lift_brand_id"] not in ("", None, "null"):
+            instance.tail_lift_brand_id = _get_fk(TailLiftBrand, data["tail_lift_brand_id"])
+
+    # File fields excluded in JSON payload; keep existing on update.
+    # For create, set to empty strings to satisfy NOT NULL text columns.
+    if creating:
+        if not instance.insurance_document:
+            instance.insurance_document = ""
+        if not instance.mulkia_document:
+            instance.mulkia_document = ""
+        if not instance.permit_document:
+            instance.permit_document = ""
+        if not instance.truck_photos:
+            instance.truck_photos = ""
+
+
+# -------------------------------
+# Change tracking
+# -------------------------------
+
+def _display_value(name, value):
+    """A raw column value as shown in the change log: lookup names, ISO dates, file URLs."""
+    if value is None or value == "":
+        return ""
+    field = VehicleMaster._meta.get_field(name)
+    if field.is_relation:
+        return lookups.get_registry().name(field.related_model, value) or ""
+    if isinstance(field, FileField):
+        return storage_url_or_none(field.storage, value) or ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+# Fields whose changes are written to the change log
+LOGGED_FIELDS = [f.name for f in VehicleMaster._meta.concrete_fields if f.name not in ("chassis_number", "version")]
+
+def display_state(v: VehicleMaster):
+    """{field: display value} of every logged field, as the change log would show it."""
+    return {name: _display_value(name, v._raw_value(VehicleMaster._meta.get_field(name))) for name in LOGGED_FIELDS}
+
+def field_changes(v: VehicleMaster, dirty: dict):
+    """{field: (old, new)} display values for the fields in a dirty_fields() result."""
+    return {
+        name: (_display_value(name, old), _display_value(name, v._raw_value(VehicleMaster._meta.get_field(name))))
+        for name, old in dirty.items()
+    }
+
+def save_changes(v: VehicleMaster):
+    """
+    Save only the columns that changed (nothing if none did) and return
+    their {field: (old, new)} display values for the change log.
+    """
+    dirty = v.dirty_fields()
+    v.save()
+    # The display values are stored in the change log, so use current names
+    lookups.get_registry(max_age=0)
+    return field_changes(v, dirty)
+
+def set_permits(v: VehicleMaster, ids):
+    """Replace the vehicle's emirates permits; returns True if they changed."""
+    known = lookups.get_registry().names(Emirate)
+    wanted = set()
+    for value in ids:
+        try:
+            emirate_id = int(value)
+        except (ValueError, TypeError):
+            continue
+        if emirate_id in known:
+            wanted.add(emirate_id)
+    if wanted == {e.id for e in v.emirates_permit.all()}:
+        return False
+    v.emirates_permit.set(wanted)
+    return True
+
+def _changeset(v: VehicleMaster, changes: dict, username, now):
+    """ChangeSet for the fields whose displayed value changed, or None."""
+    changes = {field: [old, new] for field, (old, new) in changes.items() if old != new}
+    if not changes:
+        return None
+    return ChangeSet(
+        timestamp=now,
+        chassis_number=v.chassis_number,
+        plate_number=v.plate_number,
+        username=username,
+        changes=changes,
+    )
+
+def write_change_log(changesets):
+    """
+    Insert changesets with one statement once the surrounding transaction
+    commits, so the row lock is not held for the log writes.
+    """
+    changesets = [c for c in changesets if c is not None]
+    if changesets:
+        transaction.on_commit(lambda: ChangeSet.objects.bulk_create(changesets, batch_size=BULK_BATCH_SIZE))
+
+def log_changes(v: VehicleMaster, changes: dict, username=None):
+    write_change_log([_changeset(v, changes, username, timezone.now())])
+
+# -------------------------------
+# Bulk upsert
+# -------------------------------
+
+BULK_BATCH_SIZE = 500
+
+BULK_FK_FIELDS = [f.name for f in VehicleMaster._meta.concrete_fields if f.is_relation]
+BULK_FILE_FIELDS = [f.name for f in VehicleMaster._meta.concrete_fields if isinstance(f, FileField)]
+
+def _validate_bulk_item(item, existing):
+    """
+    Apply one payload to a copy of a vehicle without touching the database.
+    Returns (vehicle, emirate ids or None) or raises ValueError / ValidationError /
+    ObjectDoesNotExist describing what is wrong with the item.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("item must be an object")
+    chassis_number = item.get("chassis_number")
+    if not isinstance(chassis_number, str) or not chassis_number.strip():
+        raise ValueError("chassis_number is required")
+
+    if existing and item.get("version") not in (None, "") and parse_int_or_none(item["version"]) != existing.version:
+        raise ValueError(f"version conflict: {chassis_number} is at version {existing.version}")
+
+    # Work on a copy, so a rejected item leaves the loaded row untouched
+    target = copy.copy(existing) if existing else VehicleMaster(chassis_number=chassis_number)
+    apply_payload(target, item, creating=existing is None)
+    # Lookups were checked against the registry; clean the rest without
+    # the per-row FK queries full_clean would run.
+    target.clean_fields(exclude=BULK_FK_FIELDS + BULK_FILE_FIELDS)
+    missing = [name for name in BULK_FK_FIELDS if getattr(target, f"{name}_id") is None]
+    if missing:
+        raise ValueError(f"Missing values for: {', '.join(missing)}")
+
+    emirate_ids = None
+    if "emirates_permit_ids" in item:
+        raw = item["emirates_permit_ids"] or []
+        if not isinstance(raw, list):
+            raise ValueError("emirates_permit_ids must be a list")
+        emirate_ids = {lookups.resolve(Emirate, e) for e in raw}
+    return target, emirate_ids
+
+def bulk_upsert_vehicles(items, username, dry_run=False):
+    """
+    Create or update many vehicles in one transaction. Every item is
+    validated before anything is written; invalid items are reported and
+    skipped. Vehicles, permit links and change-log rows are written with a
+    handful of bulk statements. Returns one result per item, in order.
+    With dry_run the results say what would happen and nothing is saved.
+    """
+    results = [None] * len(items)
+    chassis_numbers = [
+        item.get("chassis_number") for item in items
+        if isinstance(item, dict) and isinstance(item.get("chassis_number"), str)
+    ]
+    plates = [
+        item.get("plate_number") for item in items
+        if isinstance(item, dict) and item.get("plate_number")
+    ]
+    # Change-log display values are stored, so resolve them with current names
+    lookups.get_registry(max_age=0)
+    with transaction.atomic():
+        # bulk_update cannot make each row conditional on its version, so
+        # batches still lock the rows they are about to change; a dry run
+        # changes nothing, so it reads without blocking writers
+        vehicles = VehicleMaster.objects if dry_run else VehicleMaster.objects.select_for_update()
+        existing = {v.pk: v for v in vehicles.filter(pk__in=chassis_numbers)}
+        plate_owners = dict(
+            VehicleMaster.objects.filter(plate_number__in=plates).values_list("plate_number", "chassis_number")
+        )
+
+        creates, updates, permits = [], [], {}
+        changed_fields = set()
+        changesets = []
+        seen_chassis, seen_plates = set(), set()
+        now = timezone.now()
+
+        for index, item in enumerate(items):
+            result = {"index": index, "chassis_number": item.get("chassis_number") if isinstance(item, dict) else None}
+            results[index] = result
+            chassis_number = result["chassis_number"] if isinstance(result["chassis_number"], str) else None
+            try:
+                if chassis_number in seen_chassis:
+                    raise ValueError("chassis_number appears more than once in the batch")
+                current = existing.get(chassis_number)
+                target, emirate_ids = _validate_bulk_item(item, current)
+                owner = plate_owners.get(target.plate_number)
+                if target.plate_number in seen_plates or (owner and owner != target.pk):
+                    raise ValueError(f"plate_number {target.plate_number} is already in use")
+            except ValidationError as e:
+                result.update(status="error", errors=e.message_dict)
+                continue
+            except (ValueError, ObjectDoesNotExist) as e:
+                result.update(status="error", errors={"__all__": [str(e)]})
+                continue
+            seen_chassis.add(target.pk)
+            seen_plates.add(target.plate_number)
+            if current is not None:
+                existing[target.pk] = target
+
+            if emirate_ids is not None:
+                permits[target.pk] = emirate_ids
+            if current is None:
+                creates.append(target)
+                result["status"] = "created"
+                continue
+            dirty = target.dirty_fields()
+            if dirty:
+                target.version += 1
+                updates.append(target)
+                changed_fields.update(dirty)
+                changesets.append(_changeset(target, field_changes(target, dirty), username, now))
+            result["status"] = "updated" if dirty else "unchanged"
+
+        stale_links, new_links, permits_changed = _diff_permits(permits)
+        permits_only = []
+        for result in results:
+            if result["status"] == "unchanged" and result["chassis_number"] in permits_changed:
+                result["status"] = "updated"
+                permits_only.append(result["chassis_number"])
+                existing[result["chassis_number"]].version += 1
+        if dry_run:
+            # Validated and diffed against the database; nothing is written
+            return results
+
+        VehicleMaster.objects.bulk_create(creates, batch_size=BULK_BATCH_SIZE)
+        if updates:
+            VehicleMaster.objects.bulk_update(updates, sorted(changed_fields | {"version"}), batch_size=BULK_BATCH_SIZE)
+        through = VehicleMaster.emirates_permit.through
+        if stale_links:
+            through.objects.filter(id__in=stale_links).delete()
+        through.objects.bulk_create(new_links, batch_size=BULK_BATCH_SIZE)
+        if permits_only:
+            VehicleMaster.objects.filter(pk__in=permits_only).update(version=F("version") + 1)
+
+        versions = {v.pk: v.version for v in [*creates, *existing.values()]}
+        for result in results:
+            if result["status"] != "error":
+                result["version"] = versions[result["chassis_number"]]
+
+        write_change_log(changesets)
+
+        changed = [r["chassis_number"] for r in results if r["status"] in ("created", "updated")]
+        if changed:
+            # bulk_create/bulk_update bypass the model signals
+            vehicles_changed.send(sender=VehicleMaster, chassis_numbers=changed)
+    return results
+
+def _diff_permits(permits):
+    """
+    Compare wanted emirates permits of several vehicles with the stored
+    links in one read. Returns (link ids to delete, links to insert, chassis
+    numbers whose permits change).
+    """
+    through = VehicleMaster.emirates_permit.through
+    if not permits:
+        return [], [], set()
+    current = {}
+    for link_id, vehicle_id, emirate_id in through.objects.filter(
+        vehiclemaster_id__in=list(permits)
+    ).values_list("id", "vehiclemaster_id", "emirate_id"):
+        current.setdefault(vehicle_id, {})[emirate_id] = link_id
+
+    stale, missing, changed = [], [], set()
+    for vehicle_id, emirate_ids in permits.items():
+        linked = current.get(vehicle_id, {})
+        removed = [link_id for emirate_id, link_id in linked.items() if emirate_id not in emirate_ids]
+        added = [emirate_id for emirate_id in emirate_ids if emirate_id not in linked]
+        stale.extend(removed)
+        missing.extend(through(vehiclemaster_id=vehicle_id, emirate_id=emirate_id) for emirate_id in added)
+        if removed or added:
+            changed.add(vehicle_id)
+    return stale, missing, changed
@@ -123,6 +123,18 @@ STATIC_URL = 'static/'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Background export artifacts (office_user.export_jobs); not served as media
+EXPORT_ROOT = BASE_DIR / 'exports'
+# Run export jobs on a thread of the web process; set to False when a
+# separate `manage.py run_export_jobs` worker is running
+EXPORT_JOBS_IN_PROCESS = True
+
+# Change log retention (office_user.archive): `manage.py archive_change_log`
+# moves entries older than this many days into monthly gzip NDJSON files
+# here; they stay searchable through the change log API
+CHANGE_LOG_RETENTION_DAYS = 365
+CHANGE_LOG_ARCHIVE_ROOT = BASE_DIR / 'archive' / 'change_log'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 